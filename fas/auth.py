@@ -33,9 +33,64 @@ except ImportError:
     # TG-1.0.x
     from turbogears.identity import IdentityWrapper
 
+from sqlalchemy import select, and_
 from sqlalchemy.exc import InvalidRequestError
 
-from fas.model import GroupsTable, PersonRoles
+from fas.model import GroupsTable, PeopleTable, PersonRoles, \
+        request_role_maps
+
+class RoleMap(object):
+    '''Every role a person has, looked up in memory.
+
+    :arg roles: `PersonRoles` of the person
+    '''
+    def __init__(self, roles):
+        self.by_group_id = {}
+        self.by_group_name = {}
+        for role in roles:
+            self.by_group_id[role.group_id] = role
+            self.by_group_name[role.group.name] = role
+
+    def role(self, group):
+        '''Return the role in `group` (a Groups object) or None.'''
+        return self.by_group_id.get(group.id)
+
+    def role_by_name(self, name):
+        '''Return the role in the group called `name` or None.'''
+        return self.by_group_name.get(name)
+
+    def approved(self, group_name):
+        '''Whether the role in the group called `group_name` is approved.'''
+        role = self.by_group_name.get(group_name)
+        return role is not None and role.role_status == 'approved'
+
+def role_map(person):
+    '''Return the :class:`RoleMap` of `person`.
+
+    The roles are read with one query the first time a check needs them
+    during a request and shared by all the other checks of that request.
+    Changing memberships through `People` drops the maps again.
+
+    :arg person: People object or username
+    :returns: a :class:`RoleMap`
+    '''
+    if isinstance(person, basestring):
+        key = ('username', person)
+    else:
+        key = ('id', person.id)
+    maps = request_role_maps()
+    if maps is not None and key in maps:
+        return maps[key]
+
+    if isinstance(person, basestring):
+        roles = PersonRoles.query.join('member').filter_by(
+                username=person).all()
+    else:
+        roles = PersonRoles.query.filter_by(member=person).all()
+    roles = RoleMap(roles)
+    if maps is not None:
+        maps[key] = roles
+    return roles
 
 def is_admin(person):
     '''Checks if the user is a FAS admin.
@@ -70,13 +125,8 @@ def check_membership(person, group):
             return True
     elif isinstance(person, basestring):
         # Username
-        try:
-            PersonRoles.query.filter_by(role_status='approved').join('group'
-                    ).filter_by(name=group).join('member'
-                            ).filter_by(username=person).one()
+        if role_map(person).approved(group):
             return True
-        except InvalidRequestError:
-            pass
     else:
         # People object
         try:
@@ -101,26 +151,12 @@ def can_admin_group(person, group, role=None):
         if group.owner.username == person:
             return True
         if not role:
-            try:
-                PersonRoles.query.filter_by(group=group, role_status='approved',
-                        role_type='administrator').join('member'
-                                ).filter_by(username=person).one()
-                return True
-            except InvalidRequestError:
-                # Not in the group
-                pass
+            role = role_map(person).role(group)
     else:
         if group.owner.username == person:
             return True
         if not role:
-            try:
-                PersonRoles.query.filter_by(group=group,
-                    member=person,
-                    role_status='approved', role_type='administrator').one()
-                return True
-            except InvalidRequestError:
-                # Not in the group
-                pass
+            role = role_map(person).role(group)
     if role and role.role_status == 'approved' and \
             role.role_type == 'administrator':
         return True
@@ -141,21 +177,10 @@ def can_sponsor_group(person, group):
     if isinstance(person, basestring):
         if group.owner.username == person:
             return True
-        try:
-            role = PersonRoles.query.filter_by(group=group).join('member'
-                    ).filter_by(username=person).one()
-        except InvalidRequestError:
-            # Not in the group
-            pass
     else:
         if group.owner == person:
             return True
-        try:
-            role = PersonRoles.query.filter_by(group=group,
-                member=person).one()
-        except InvalidRequestError:
-            # Not in the group
-            pass
+    role = role_map(person).role(group) or ''
 
     if role and ((role.role_status == 'approved' and \
             role.role_type == 'sponsor') or can_admin_group(person, group,
@@ -172,12 +197,9 @@ def is_approved(person, group):
     Returns True if the user is an approved member of a group
     '''
     if isinstance(person, basestring):
-        try:
-            PersonRoles.query.filter_by(group=group, role_status='approved'
-                    ).join('member').filter_by(username=person).one()
+        role = role_map(person).role(group)
+        if role and role.role_status == 'approved':
             return True
-        except InvalidRequestError:
-            pass
     else:
         try:
             if person.group_roles[group.name].role_status == 'approved':
@@ -195,14 +217,8 @@ def cla_done(person):
     '''
     cla_done_group = config.get('cla_done_group')
     if isinstance(person, basestring):
-        try:
-            PersonRoles.query.filter_by(role_status='approved').join('group'
-                    ).filter_by(name=cla_done_group).join('member'
-                            ).filter_by(username=person).one()
+        if role_map(person).approved(cla_done_group):
             return True
-        except InvalidRequestError:
-            # Not in the group
-            pass
     try:
         if person.group_roles[cla_done_group].role_status == 'approved':
             return True
@@ -223,14 +239,8 @@ def standard_cla_done(person):
     '''
     standard_cla_group = config.get('cla_standard_group')
     if isinstance(person, basestring):
-        try:
-            PersonRoles.query.filter_by(role_status='approved').join('group'
-                    ).filter_by(name=standard_cla_group).join('member'
-                            ).filter_by(username=person).one()
+        if role_map(person).approved(standard_cla_group):
             return True
-        except InvalidRequestError:
-            # Not in the group
-            pass
     try:
         if person.group_roles[standard_cla_group].role_status == 'approved':
             return True
@@ -263,10 +273,9 @@ def undeprecated_cla_done(person):
         name = person.username
 
     cla_roles = set()
-    for role in PersonRoles.query.filter_by(role_status='approved').join('group'
-            ).filter(GroupsTable.c.group_type=='cla').join('member'
-                    ).filter_by(username=name).all():
-        cla_roles.add(role.group.name)
+    for group_name, role in role_map(name).by_group_name.iteritems():
+        if role.role_status == 'approved' and role.group.group_type == 'cla':
+            cla_roles.add(group_name)
 
     # If the cla is considered signed only because of deprecated groups, 
     # return negative here.
@@ -359,6 +368,44 @@ def can_view_group(person, group):
             return False
     return True
 
+def filter_viewable_groups(person, groups):
+    '''Return the groups that the user can view.
+
+    This gives the same answer as calling :func:`can_view_group` for each
+    group but looks up the user's roles and the groups they own once for
+    the whole list.
+
+    :arg person: People object or username to check for privileges to view
+        the groups
+    :arg groups: Groups objects to filter
+    :returns: list of the groups `person` can view, in the original order
+    '''
+    groups = list(groups)
+    privileged_view_groups = re.compile(config.get('privileged_view_groups'))
+    privileged = [group for group in groups
+            if privileged_view_groups.match(group.name)]
+    if not privileged or is_admin(person):
+        return groups
+
+    roles = role_map(person)
+    owned = frozenset()
+    if isinstance(person, basestring):
+        # can_admin_group only honours ownership when given a username
+        owned = frozenset(row[0] for row in select([GroupsTable.c.id],
+            and_(GroupsTable.c.owner_id == PeopleTable.c.id,
+                PeopleTable.c.username == person,
+                GroupsTable.c.id.in_([group.id for group in privileged]))
+            ).execute())
+
+    hidden = set()
+    for group in privileged:
+        role = roles.role(group)
+        if group.id in owned or (role and role.role_status == 'approved'
+                and role.role_type == 'administrator'):
+            continue
+        hidden.add(group.id)
+    return [group for group in groups if group.id not in hidden]
+
 def can_apply_group(person, group, applicant):
     '''Check whether the user can apply applicant to the group.
 
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+'''
+Memcached helpers shared by the FAS controllers and model.
+
+Expensive, frequently requested data is stored with :class:`CachedValue`.
+Each value belongs to a generation which code that changes the underlying
+data bumps with :func:`invalidate`.  When a value is stale only one worker
+rebuilds it while the others keep serving the old copy.
+'''
+
+import os
+import time
+import threading
+import zlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from turbogears import config
+
+import memcache
+
+from fas import metrics
+
+import logging
+log = logging.getLogger('fas.cache')
+
+class Client(memcache.Client):
+    '''memcache client counting hits and misses for the metrics.'''
+    def get(self, key):
+        value = memcache.Client.get(self, key)
+        if value is None:
+            metrics.inc('fas_memcache_requests_total', (('result', 'miss'),))
+        else:
+            metrics.inc('fas_memcache_requests_total', (('result', 'hit'),))
+        return value
+
+    def get_multi(self, keys, key_prefix=''):
+        values = memcache.Client.get_multi(self, keys, key_prefix)
+        metrics.inc('fas_memcache_requests_total', (('result', 'hit'),),
+                len(values))
+        metrics.inc('fas_memcache_requests_total', (('result', 'miss'),),
+                len(keys) - len(values))
+        return values
+
+metrics.describe('fas_memcache_requests_total', 'counter',
+        'Keys looked up in memcached, by result')
+
+memcached_servers = config.get('memcached_server').split(',')
+# Setup our memcache client
+mc = Client(memcached_servers)
+
+def _generation_key(generation):
+    return 'generation:%s' % generation
+
+def invalidate(generation):
+    '''Mark every value belonging to `generation` as stale.
+
+    Call this whenever the data behind the cached values is modified.  The
+    change is usually not committed yet so values rebuilt during the next
+    ``cache.dirty_grace`` seconds are only kept until that window ends.
+
+    :arg generation: Name of the generation, for instance 'group_data'
+    '''
+    mc.set(_generation_key(generation), time.time())
+
+class CachedValue(object):
+    '''A value in memcached that is rebuilt by a single worker at a time.
+
+    Values too large for one memcached item (the default limit is 1MB) are
+    pickled, compressed and stored in ``cache.chunk_size`` pieces.  The
+    entry under `key` then lists the pieces, which are named after the
+    build that wrote them so a reader never mixes pieces of two builds.
+
+    :arg key: memcached key to store the value under
+    :arg generation: Name of the generation the value belongs to
+    :kwarg ttl: Seconds a value stays fresh if nothing invalidates it
+    '''
+    def __init__(self, key, generation, ttl=None):
+        self.key = key
+        self.lock_key = key + ':lock'
+        self.uncacheable_key = key + ':uncacheable'
+        self.generation = generation
+        if ttl is None:
+            ttl = int(config.get('cache.ttl', 86400))
+        self.ttl = ttl
+        self.min_compress_len = int(config.get('cache.min_compress_len',
+            65536))
+        self.chunk_size = int(config.get('cache.chunk_size', 900000))
+
+    def _load(self):
+        '''Return the stored entry with its value or None.'''
+        entry = mc.get(self.key)
+        if not entry or 'chunks' not in entry:
+            return entry
+        keys = ['%s:%s:%d' % (self.key, entry['build'], index)
+                for index in range(entry['chunks'])]
+        chunks = mc.get_multi(keys)
+        if len(chunks) != len(keys):
+            # Some of the pieces were evicted
+            return None
+        entry['value'] = pickle.loads(zlib.decompress(
+            ''.join([chunks[key] for key in keys])))
+        return entry
+
+    def _store(self, value, changed, expires):
+        '''Store `value`.
+
+        :returns: False if memcached did not take it
+        '''
+        entry = dict(changed=changed, expires=expires)
+        data = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        if len(data) <= self.chunk_size:
+            entry['value'] = value
+            # Keep the entry past its expiry so there is a stale copy to
+            # serve while it is being rebuilt.
+            return bool(mc.set(self.key, entry, self.ttl * 2,
+                min_compress_len=self.min_compress_len))
+
+        entry['build'] = '%x%s' % (int(time.time() * 1000),
+                os.urandom(4).encode('hex'))
+        entry['chunks'] = (len(data) + self.chunk_size - 1) // self.chunk_size
+        chunks = {}
+        for index in range(entry['chunks']):
+            chunks['%s:%s:%d' % (self.key, entry['build'], index)] = \
+                    data[index * self.chunk_size:(index + 1) * self.chunk_size]
+        # set_multi returns the keys it could not store
+        if mc.set_multi(chunks, self.ttl * 2):
+            return False
+        return bool(mc.set(self.key, entry, self.ttl * 2))
+
+    def get(self, builder, force_refresh=False):
+        '''Return the cached value, rebuilding it if needed.
+
+        :arg builder: Callable returning a fresh value
+        :kwarg force_refresh: Rebuild the value even if it is still fresh
+        :returns: The value.  When another worker is already rebuilding a
+            stale value, the stale value is returned.
+        '''
+        now = time.time()
+        changed = mc.get(_generation_key(self.generation)) or 0
+        if mc.get(self.uncacheable_key) == changed:
+            # Storing it failed recently, don't try again for a while
+            return builder()
+        entry = self._load()
+        if entry and not force_refresh and entry['changed'] == changed \
+                and now < entry['expires']:
+            return entry['value']
+
+        lock_ttl = int(config.get('cache.lock_ttl', 120))
+        locked = mc.add(self.lock_key, 1, lock_ttl)
+        if not locked:
+            if entry and not force_refresh:
+                # Somebody else is rebuilding it
+                return entry['value']
+            # Nothing to serve yet.  Give the other worker a moment before
+            # doing the work ourselves.
+            deadline = now + float(config.get('cache.lock_wait', 10))
+            while time.time() < deadline:
+                time.sleep(0.1)
+                building = mc.get(self.lock_key) is not None
+                entry = self._load()
+                if entry and entry['changed'] == changed:
+                    return entry['value']
+                if not building:
+                    # The other worker finished without storing a value
+                    # (or it was evicted), waiting longer won't help.
+                    break
+
+        try:
+            value = builder()
+            now = time.time()
+            grace = int(config.get('cache.dirty_grace', 30))
+            if now < changed + grace:
+                # The change that invalidated us may not have been committed
+                # when we read the data.  Only trust this copy for a little
+                # while.
+                expires = changed + grace
+            else:
+                expires = now + self.ttl
+            if not self._store(value, changed, expires):
+                log.warning('Could not store %s in memcached, not caching it'
+                        ' for %d seconds' % (self.key, lock_ttl))
+                mc.set(self.uncacheable_key, changed, lock_ttl)
+        finally:
+            if locked:
+                mc.delete(self.lock_key)
+        return value
+
+class SharedCache(object):
+    '''Small values kept in process memory backed by memcached.
+
+    Lookups are answered from a bounded, least recently used in-process
+    copy when possible.  Every lookup still asks memcached (in one round
+    trip) whether the generation changed or the key was revoked so that
+    :func:`invalidate` and :meth:`revoke` take effect in every process.
+
+    :arg prefix: Prefix for the memcached keys
+    :arg generation: Name of the generation the values belong to
+    :kwarg ttl: Seconds a value may be used for
+    :kwarg size: Most values to keep in process memory
+    '''
+    def __init__(self, prefix, generation, ttl=60, size=10000):
+        self.prefix = prefix
+        self.generation = generation
+        self.ttl = ttl
+        self.size = size
+        self.local = {}
+        self.lock = threading.Lock()
+
+    def _key(self, key):
+        return '%s:%s' % (self.prefix, key)
+
+    def _revoked_key(self, key):
+        return '%s-revoked:%s' % (self.prefix, key)
+
+    def get(self, key):
+        '''Return the value stored for `key` or None.'''
+        now = time.time()
+        stamps = mc.get_multi([_generation_key(self.generation),
+            self._revoked_key(key)])
+        if self._revoked_key(key) in stamps:
+            return None
+        changed = stamps.get(_generation_key(self.generation)) or 0
+
+        self.lock.acquire()
+        try:
+            entry = self.local.get(key)
+            if entry:
+                if entry['changed'] == changed and now < entry['expires']:
+                    entry['used'] = now
+                    return entry['value']
+                del self.local[key]
+        finally:
+            self.lock.release()
+
+        entry = mc.get(self._key(key))
+        if not entry or entry['changed'] != changed \
+                or now >= entry['expires']:
+            return None
+        self._store_local(key, entry, now)
+        return entry['value']
+
+    def set(self, key, value):
+        '''Store `value` for `key`.'''
+        now = time.time()
+        changed = mc.get(_generation_key(self.generation)) or 0
+        if now < changed + int(config.get('cache.dirty_grace', 30)):
+            # The change that invalidated the cache may not be committed
+            # yet so the value could already be stale.
+            return
+        entry = dict(value=value, changed=changed, expires=now + self.ttl)
+        mc.set(self._key(key), entry, self.ttl)
+        self._store_local(key, entry, now)
+
+    def revoke(self, key):
+        '''Forget `key` in every process.'''
+        mc.set(self._revoked_key(key), 1, self.ttl)
+        mc.delete(self._key(key))
+        self.lock.acquire()
+        try:
+            self.local.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def _store_local(self, key, entry, now):
+        entry = dict(entry, used=now)
+        self.lock.acquire()
+        try:
+            if len(self.local) >= self.size:
+                # Drop the least recently used tenth
+                by_use = sorted(self.local.iteritems(),
+                        key=lambda item: item[1]['used'])
+                for old_key, old_entry in by_use[:max(1, self.size // 10)]:
+                    del self.local[old_key]
+            self.local[key] = entry
+        finally:
+            self.lock.release()
@@ -50,26 +50,76 @@ from fas.util import available_languages
 from fas import plugin
 
 import os
+import base64
+import zlib
 
 import datetime
 
+from sqlalchemy.sql import select
+
+from fas.cache import mc
+from fas.sqlstats import SqlStatsFilter
+from fas.metrics import MetricsFilter
+from fas import metrics as fas_metrics
+
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
+def encode_session(data):
+    '''Encode session data for the text column of the session table.
+
+    Binary pickles compressed with zlib take a fraction of the space of the
+    text pickles used before.  They are base64 encoded and marked with a
+    ``z:`` prefix so that both kinds can be read.
+    '''
+    return 'z:' + base64.b64encode(zlib.compress(
+        pickle.dumps(data, pickle.HIGHEST_PROTOCOL)))
+
+def decode_session(encoded):
+    '''Decode session data written by :func:`encode_session`.'''
+    encoded = str(encoded)
+    if encoded.startswith('z:'):
+        return pickle.loads(zlib.decompress(base64.b64decode(encoded[2:])))
+    # Written before the data was compressed
+    return pickle.loads(encoded)
+
 class SQLAlchemyStorage:
+    '''Keep CherryPy sessions in the session table.
+
+    Sessions are only written when their data changed or their expiration
+    time moved by more than ``session.expiry_slack`` seconds.  With
+    ``session.memcache`` turned on they are also kept in memcached so that
+    most requests don't have to read the table.
+    '''
     def __init__(self):
         pass
 
+    def _cache_key(self, session_id):
+        return 'session:%s' % session_id
+
+    def _remember_loaded(self, session_id, encoded, expiration_time):
+        # What the request started with, to tell whether save needs to write
+        try:
+            request.fas_session_loaded = (session_id, encoded,
+                    expiration_time)
+        except AttributeError:
+            pass
+
     def load(self, session_id):
+        if config.get('session.memcache', False):
+            cached = mc.get(self._cache_key(session_id))
+            if cached:
+                encoded, expiration_time = cached
+                self._remember_loaded(session_id, encoded, expiration_time)
+                return (decode_session(encoded), expiration_time)
         s = Session.query.get(session_id)
         if not s:
             return None
         expiration_time = s.expiration_time
-        pickled_data = s.data
-        data = pickle.loads(pickled_data.encode('utf-8'))
-        return (data, expiration_time)
+        self._remember_loaded(session_id, s.data, expiration_time)
+        return (decode_session(s.data), expiration_time)
 
     # This is an iffy one.  CherryPy's built in session
     # storage classes use delete(self, id=None), but it
@@ -78,19 +128,39 @@ class SQLAlchemyStorage:
     def delete(self, session_id=None):
         if session_id is None:
             session_id = cherrypy.session.id
+        if config.get('session.memcache', False):
+            mc.delete(self._cache_key(session_id))
         s = Session.query.get(session_id)
         session.delete(s)
         session.flush()
 
     def save(self, session_id, data, expiration_time):
-        pickled_data = pickle.dumps(data)
+        try:
+            loaded_id, loaded, loaded_expiration = request.fas_session_loaded
+        except AttributeError:
+            loaded_id = None
+        # Compare the data rather than its encoding: pickles of equal dicts
+        # can differ in the order of the keys
+        if loaded_id == session_id and \
+                expiration_time - loaded_expiration < datetime.timedelta(
+                    seconds=int(config.get('session.expiry_slack', 300))) \
+                and decode_session(loaded) == data:
+            # Nothing worth writing
+            return
+
+        encoded = encode_session(data)
         s = Session.query.get(session_id)
         if not s:
             s = Session()
         s.id = session_id
-        s.data = pickled_data
+        s.data = encoded
         s.expiration_time = expiration_time
         session.flush()
+        self._remember_loaded(session_id, encoded, expiration_time)
+        if config.get('session.memcache', False):
+            ttl = expiration_time - datetime.datetime.now()
+            mc.set(self._cache_key(session_id), (encoded, expiration_time),
+                    max(1, ttl.days * 86400 + ttl.seconds))
 
     def acquire_lock(self):
         pass
@@ -99,9 +169,23 @@ class SQLAlchemyStorage:
         pass
 
     def clean_up(self, sess):
-        result = SessionTable.delete(
-            SessionTable.c.expiration_time.__lt__(datetime.datetime.now())
-            ).execute()
+        '''Delete expired sessions a batch at a time.
+
+        Deleting them all at once can hold locks on a large part of the
+        table for a long time.
+        '''
+        batch_size = int(config.get('session.cleanup_batch', 1000))
+        now = datetime.datetime.now()
+        while True:
+            expired = select([SessionTable.c.id],
+                    SessionTable.c.expiration_time < now,
+                    limit=batch_size).execute().fetchall()
+            if not expired:
+                break
+            SessionTable.delete(SessionTable.c.id.in_(
+                [row[0] for row in expired])).execute()
+            if len(expired) < batch_size:
+                break
 
 config.update({'session_filter.storage_class': SQLAlchemyStorage})
 
@@ -141,6 +225,8 @@ turbogears.view.variable_providers.append(add_custom_stdvars)
 
 class Root(plugin.RootController):
 
+    _cp_filters = [SqlStatsFilter(), MetricsFilter()]
+
     user = User()
     group = Group()
     fpca = FPCA()
@@ -245,6 +331,17 @@ class Root(plugin.RootController):
     def logout(self):
         return f_ctrlers.logout()
 
+    @expose(content_type='text/plain; version=0.0.4')
+    def metrics(self):
+        '''Serve the metrics of every process in Prometheus text format.
+
+        Only the hosts listed in metrics.allowed_hosts may read them.
+        '''
+        allowed = config.get('metrics.allowed_hosts', ['127.0.0.1', '::1'])
+        if request.remote_addr not in allowed:
+            raise cherrypy.HTTPError(403)
+        return fas_metrics.render()
+
     @expose()
     def language(self, locale):
         if locale not in available_languages():
@@ -6,12 +6,29 @@ messages.  If it is not installed, it will return silently.
 
 """
 
+import time
 import warnings
 
+from fas import metrics
+
+metrics.describe('fas_fedmsg_publish_duration_seconds', 'histogram',
+        'Time taken to publish fedmsg messages')
+metrics.describe('fas_fedmsg_publish_failures_total', 'counter',
+        'fedmsg messages that could not be published')
 
 def send_message(*args, **kwargs):
     try:
         import fedmsg
+    except ImportError, e:
+        # Not a failure to publish, fedmsg is optional
+        warnings.warn(str(e))
+        return
+    start = time.time()
+    try:
         fedmsg.publish(*args, **kwargs)
     except Exception, e:
+        metrics.inc('fas_fedmsg_publish_failures_total')
         warnings.warn(str(e))
+    else:
+        metrics.observe('fas_fedmsg_publish_duration_seconds',
+                time.time() - start)
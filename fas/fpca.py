@@ -37,9 +37,10 @@ import fas.fedmsgshim
 
 from fedora.tg.utils import request_format
 
-from fas.model import People, Groups, Log
+from fas.model import People, Groups, Log, memberships_changed
 from fas.auth import is_admin, standard_cla_done, undeprecated_cla_done
 from fas.util import send_mail
+from fas.cache import invalidate
 import fas
 
 
@@ -171,6 +172,7 @@ class FPCA(controllers.Controller):
                     role.role_status = 'unapproved'
             try:
                 session.flush()
+                memberships_changed()
             except DBAPIError, error:
                 turbogears.flash(_('Error removing cla and dependent groups' \
                         ' for %(person)s\n Error was: %(error)s') %
@@ -284,6 +286,7 @@ Thanks!
         # Compare old information to new to see if any changes have been made
         if human_name and person.human_name != human_name:
             person.human_name = human_name
+            invalidate('user_data')
         if telephone and person.telephone != telephone:
             person.telephone = telephone
         if postal_address and person.postal_address != postal_address:
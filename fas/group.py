@@ -34,7 +34,6 @@ from turbogears import controllers, expose, identity, validate, validators, \
 from turbogears.database import session
 
 import cherrypy
-import sqlalchemy
 from sqlalchemy import select, func
 from sqlalchemy.sql import and_
 from sqlalchemy.orm import eagerload
@@ -46,7 +45,8 @@ import fas.fedmsgshim
 import fas
 from fas.model import People, PeopleTable, PersonRoles, PersonRolesTable, \
         Groups, GroupsTable, Log
-from fas.auth import can_view_group, can_create_group, can_admin_group, \
+from fas.auth import can_view_group, filter_viewable_groups, \
+        can_create_group, can_admin_group, \
         can_edit_group, can_apply_group, can_remove_user, can_upgrade_user, \
         can_sponsor_user, can_downgrade_user, is_approved
 
@@ -54,6 +54,9 @@ from fas.validators import UnknownGroup, KnownGroup, ValidGroupType, \
         ValidRoleSort, KnownUser
 
 from fas.util import send_mail
+from fas.cache import invalidate
+from fas.records import MemberRecord
+from fas.jsonstream import stream_json, JsonObject, JsonArray
 
 class GroupView(validators.Schema):
     groupname = KnownGroup
@@ -138,6 +141,45 @@ class GroupSendInvite(validators.Schema):
 #
 #findUserForm = widgets.ListForm(fields=findUser(), submit_text=_('Invite'))
 
+def stream_group_list(groups, search):
+    '''Produce the json response of :meth:`Group.list` with members.
+
+    Memberships are read ``json.batch_size`` groups at a time and sent as
+    they are read.
+
+    :arg groups: The groups to list
+    :arg search: The search string the groups were selected with
+    :returns: iterator of (key, value) pairs for :func:`stream_json`
+    '''
+    def memberships():
+        batch_size = int(config.get('json.batch_size', 1000))
+        # Only the groups being listed, not every group in the table
+        group_ids = sorted(group.id for group in groups)
+        for start in range(0, len(group_ids), batch_size):
+            members = select([PersonRoles.person_id, PersonRoles.group_id,
+                PersonRoles.role_type], and_(PersonRoles.role_status=='approved',
+                    PersonRoles.group_id.in_(group_ids[start:start + batch_size]))
+                ).order_by(PersonRoles.group_id).execute()
+            group_id = None
+            for member in members:
+                if member[1] != group_id:
+                    if group_id is not None:
+                        yield group_id, group_members
+                    group_id = member[1]
+                    group_members = []
+                group_members.append(MemberRecord(member[0], member[2]))
+            if group_id is not None:
+                yield group_id, group_members
+
+    yield 'groups', JsonArray(groups)
+    yield 'search', search
+    yield 'memberships', JsonObject(memberships())
+    # Same keys as the response turbogears builds when not streaming
+    if groups:
+        yield 'tg_flash', None
+    else:
+        yield 'tg_flash', _("No Groups found matching '%s'") % search
+
 class Group(controllers.Controller):
 
     def __init__(self):
@@ -299,6 +341,7 @@ class Group(controllers.Controller):
             Log(author_id=person.id, description='%s created group %s' %
                 (person.username, group.name))
             session.flush()
+            invalidate('groups')
         except TypeError:
             turbogears.flash(_("The group: '%s' could not be created.") % groupname)
             return dict()
@@ -373,6 +416,10 @@ class Group(controllers.Controller):
                         changed.append(field)
 
                 session.flush()
+                if changed:
+                    invalidate('groups')
+                if 'group_type' in changed:
+                    invalidate('group_data')
             except:
                 turbogears.flash(_('The group details could not be saved.'))
             else:
@@ -397,28 +444,21 @@ class Group(controllers.Controller):
         person = People.by_username(username)
 
         memberships = {}
-        groups = []
         re_search = re.sub(r'\*', r'%', search).lower()
         results = Groups.query.filter(Groups.name.like(re_search)).order_by('name').all()
+        if self.jsonRequest() and with_members:
+            # Every membership of every group can be a lot of data.  Send
+            # it as it is read from the database.
+            groups = filter_viewable_groups(person, results)
+            return stream_json(stream_group_list(groups, search))
         if self.jsonRequest():
-            if with_members:
-                membersql = sqlalchemy.select([PersonRoles.person_id, PersonRoles.group_id, PersonRoles.role_type], PersonRoles.role_status=='approved').order_by(PersonRoles.group_id)
-                members = membersql.execute()
-                for member in members:
-                    try:
-                        memberships[member[1]].append({'person_id': member[0], 'role_type': member[2]})
-                    except KeyError:
-                        memberships[member[1]]=[{'person_id': member[0], 'role_type': member[2]}]
-            else:
-                memberships = []
+            memberships = []
 
-                if len(results) == 1 and results[0].name == search and can_view_group(person, results[0]):
-                    turbogears.redirect('/group/view/%s' % (results[0].name))
-                    return dict()
+            if len(results) == 1 and results[0].name == search and can_view_group(person, results[0]):
+                turbogears.redirect('/group/view/%s' % (results[0].name))
+                return dict()
 
-        for group in results:
-            if can_view_group(person, group):
-                groups.append(group)
+        groups = filter_viewable_groups(person, results)
         if not len(groups):
             turbogears.flash(_("No Groups found matching '%s'") % search)
         return dict(groups=groups, search=search, memberships=memberships)
@@ -433,7 +473,6 @@ class Group(controllers.Controller):
         """
         username = turbogears.identity.current.user_name
         person = People.by_username(username)
-        groups = []
         results = Groups.by_type(grptype)
         if self.jsonRequest():
             if len(results) == 1 \
@@ -442,9 +481,7 @@ class Group(controllers.Controller):
                 turbogears.redirect('/group/view/%s' % (results[0].name))
                 return dict()
 
-        for group in results:
-            if can_view_group(person, group):
-                groups.append(group)
+        groups = filter_viewable_groups(person, results)
         if not len(groups):
             turbogears.flash(_("No Groups found of type '%s'") % grptype)
         return dict(groups=groups, search=grptype)
@@ -25,7 +25,10 @@ from turbogears import controllers, expose, identity, config
 
 from sqlalchemy.exc import InvalidRequestError
 import sqlalchemy
-from sqlalchemy import select
+from sqlalchemy import select, func, and_, or_
+from sqlalchemy.orm import eagerload
+
+from datetime import timedelta
 
 from fas.model import People
 from fas.model import Groups
@@ -33,13 +36,208 @@ from fas.model import PersonRoles
 from fas.model import PeopleTable
 from fas.model import GroupsTable
 from fas.model import PersonRolesTable
+from fas.model import SyncChangesTable
+from fas.model import avoided_queries
+
+from fas.cache import mc, CachedValue
+from fas.sqlstats import sql_report
+from fas.jsonstream import stream_json, stream_ndjson, JsonObject
+
+group_data_cache = CachedValue('group_data', 'group_data')
+# user_data is masked according to the privileges of the requester so one
+# copy is kept for each level of access.
+user_data_caches = {
+    'system': CachedValue('user_data:system', 'user_data'),
+    'thirdparty': CachedValue('user_data:thirdparty', 'user_data'),
+    'plain': CachedValue('user_data:plain', 'user_data'),
+}
+
+def sync_token():
+    '''Return the current position in the sync_changes sequence.'''
+    return select([func.coalesce(func.max(SyncChangesTable.c.id), 0)]
+            ).execute().scalar()
+
+def changes_since(since, data):
+    '''Find the groups or people that changed after a sync token.
+
+    :arg since: Token previously handed out by :func:`sync_token`
+    :arg data: 'group_data' to return changed group ids or 'user_data' to
+        return changed person ids
+    :returns: set of ids or None if the caller has to do a full sync, either
+        because the token is invalid or too old or because too much changed
+        for an incremental answer to be worthwhile.
+    '''
+    try:
+        since = int(since)
+    except (TypeError, ValueError):
+        return None
+
+    oldest = select([func.min(SyncChangesTable.c.id)]).execute().scalar()
+    if oldest is None:
+        # Nothing recorded.  Fine for a brand new database but if the client
+        # has seen changes before, they have been pruned since.
+        if since:
+            return None
+        return set()
+    if since < oldest - 1:
+        # Some of the changes after the token have been pruned
+        return None
+
+    if data == 'group_data':
+        column = SyncChangesTable.c.group_id
+        tables = ('groups', 'person_roles')
+    else:
+        column = SyncChangesTable.c.person_id
+        tables = ('people',)
+
+    # Ids are handed out when a row is inserted but become visible when the
+    # transaction commits, so a change can show up with an id lower than a
+    # token we already gave out.  Send everything from shortly before the
+    # token again to cover that; clients apply changes idempotently.
+    newer = SyncChangesTable.c.id > since
+    since_time = select([SyncChangesTable.c.changetime],
+            SyncChangesTable.c.id == since).execute().scalar()
+    if since_time:
+        overlap = timedelta(seconds=int(config.get('fas_client.sync_overlap',
+            60)))
+        newer = or_(newer, SyncChangesTable.c.changetime > since_time - overlap)
+
+    changed = select([column], and_(newer,
+        SyncChangesTable.c.tablename.in_(tables), column != None),
+        distinct=True).execute()
+    changed = set(row[0] for row in changed)
+    if len(changed) > int(config.get('fas_client.max_changes', 1000)):
+        return None
+    return changed
+
+def build_group_data(group_ids=None):
+    '''Build the group_data mapping that fasClient uses.
+
+    :kwarg group_ids: If given, only return these groups
+    :returns: dict mapping group name to the id, type and approved members
+    '''
+    groups = {}
+    groupjoin = [GroupsTable.outerjoin(PersonRolesTable,
+        PersonRolesTable.c.group_id == GroupsTable.c.id)]
+
+    group_query = select([GroupsTable.c.id, GroupsTable.c.name,
+        GroupsTable.c.group_type, PersonRolesTable.c.person_id,
+        PersonRolesTable.c.role_status, PersonRolesTable.c.role_type],
+        from_obj=groupjoin)
+    if group_ids is not None:
+        if not group_ids:
+            return groups
+        group_query = group_query.where(GroupsTable.c.id.in_(list(group_ids)))
+
+    results = group_query.execute()
+
+    for id, name, group_type, person_id, role_status, role_type in results:
+        if name not in groups:
+            groups[name] = {
+                'id': id,
+                'administrators': [],
+                'sponsors': [],
+                'users': [],
+                'type': group_type
+            }
+
+        if role_status != 'approved':
+            continue
+
+        if role_type == 'administrator':
+            groups[name]['administrators'].append(person_id)
+        elif role_type == 'sponsor':
+            groups[name]['sponsors'].append(person_id)
+        elif role_type == 'user':
+            groups[name]['users'].append(person_id)
+    return groups
+
+def build_user_data(privs, person_ids=None):
+    '''Build the user_data mapping that fasClient uses.
+
+    :arg privs: dict saying whether the requester has 'system' and
+        'thirdparty' privileges.  Passwords and ssh keys are masked
+        without them.
+    :kwarg person_ids: If given, only return these people
+    :returns: dict mapping person id to the account information of every
+        active person
+    '''
+    people = {}
+    people_query = select([
+        PeopleTable.c.id,
+        PeopleTable.c.username,
+        PeopleTable.c.password,
+        PeopleTable.c.human_name,
+        PeopleTable.c.ssh_key,
+        PeopleTable.c.email,
+        PeopleTable.c.privacy,
+        PeopleTable.c.alias_enabled
+        ], PeopleTable.c.status == 'active')
+    if person_ids is not None:
+        if not person_ids:
+            return people
+        people_query = people_query.where(
+                PeopleTable.c.id.in_(list(person_ids)))
+
+    for id, username, password, human_name, ssh_key, email, privacy, \
+            alias_enabled in people_query.execute():
+        people[id] = {
+            'username': username,
+            'password': password,
+            'human_name': human_name,
+            'ssh_key': ssh_key,
+            'email': email,
+            'alias_enabled': alias_enabled
+        }
 
-import memcache
-
-# TODO: Should this code be put somewhere else?
-memcached_servers = config.get('memcached_server').split(',')
-# Setup our memcache client
-mc = memcache.Client(memcached_servers)
+        if privacy:
+            # If they have privacy enabled, set their human_name to
+            # their username
+            people[id]['human_name'] = username
+
+        if not privs['system']:
+            people[id]['password'] = '*'
+        if not privs['thirdparty']:
+            people[id]['ssh_key'] = ''
+    return people
+
+def split_list(values):
+    '''Turn a request parameter into a list of values.
+
+    :arg values: A comma separated string or a list of strings (from
+        giving the parameter several times)
+    :returns: list of the non-empty values
+    '''
+    if values is None:
+        return []
+    if isinstance(values, basestring):
+        values = values.split(',')
+    return [v.strip() for v in values if v and v.strip()]
+
+def lookup_people(column, values):
+    '''Load several people and their memberships with one query.
+
+    :arg column: People column to match `values` against
+    :arg values: list of values to find
+    :returns: list of filtered person data as returned by
+        :meth:`People.filter_private` plus their approved and unapproved
+        memberships
+    '''
+    if not values:
+        return []
+    # Roles and, through them, groups are loaded along with the people so
+    # building the memberships below doesn't need any further queries.
+    people = People.query.filter(column.in_(values)).options(
+            eagerload('roles')).all()
+    results = []
+    for person in people:
+        person_data = person.filter_private()
+        person_data['approved_memberships'] = [role.group for role
+                in person.roles if role.role_status == 'approved']
+        person_data['unapproved_memberships'] = [role.group for role
+                in person.roles if role.role_status != 'approved']
+        results.append(person_data)
+    return results
 
 class JsonRequest(controllers.Controller):
     def __init__(self):
@@ -65,7 +263,17 @@ class JsonRequest(controllers.Controller):
 
     @identity.require(turbogears.identity.not_anonymous())
     @expose("json", allow_json=True)
-    def fas_client(self, data=None, force_refresh=None):
+    def fas_client(self, data=None, force_refresh=None, since=None):
+        '''Return the group or user data that fasClient needs.
+
+        :kwarg data: Either 'group_data' or 'user_data'
+        :kwarg force_refresh: Rebuild the cached copy of the data
+        :kwarg since: A token returned by a previous call.  If given, only
+            the groups or people changed since then are returned and the
+            ids of the ones that went away are listed in ``removed``.
+        :returns: dict with the data, a ``token`` to pass as `since` on the
+            next call and ``full`` which is False for incremental results.
+        '''
         admin_group = config.get('admingroup', 'accounts')
         system_group = config.get('systemgroup', 'fas-system')
         thirdparty_group = config.get('thirdpartygroup', 'thirdparty')
@@ -83,79 +291,49 @@ class JsonRequest(controllers.Controller):
         elif identity.in_group(thirdparty_group):
             privs['thirdparty'] = True
 
+        if data not in ('group_data', 'user_data'):
+            return dict(success=False, data={})
+
+        # Read the token before the data so that anything which changes while
+        # we are working is sent again on the next call.
+        token = sync_token()
+        changed = None
+        if since is not None:
+            changed = changes_since(since, data)
+
+        if changed is not None:
+            if data == 'group_data':
+                result = build_group_data(changed)
+                found = frozenset(g['id'] for g in result.itervalues())
+            else:
+                result = build_user_data(privs, changed)
+                found = result
+            removed = [i for i in changed if i not in found]
+            return dict(success=True, data=result, removed=removed,
+                    token=token, full=False)
+
         if data == 'group_data':
-            groups = None
-            if not force_refresh:
-                groups = mc.get('group_data')
-            if not groups:
-                groups = {}
-                groupjoin = [GroupsTable.outerjoin(PersonRolesTable,
-                    PersonRolesTable.c.group_id == GroupsTable.c.id)]
-
-                group_query = select([GroupsTable.c.id, GroupsTable.c.name,
-                    GroupsTable.c.group_type, PersonRolesTable.c.person_id,
-                    PersonRolesTable.c.role_status, PersonRolesTable.c.role_type],
-                    from_obj=groupjoin)
-
-                results = group_query.execute()
-
-                for id, name, group_type, person_id, role_status, role_type in results:
-                    if name not in groups:
-                        groups[name] = {
-                            'id': id,
-                            'administrators': [],
-                            'sponsors': [],
-                            'users': [],
-                            'type': group_type
-                        }
-
-                    if role_status != 'approved':
-                        continue
-
-                    if role_type == 'administrator':
-                        groups[name]['administrators'].append(person_id)
-                    elif role_type == 'sponsor':
-                        groups[name]['sponsors'].append(person_id)
-                    elif role_type == 'user':
-                        groups[name]['users'].append(person_id)
-
-                # Save cache - valid for 15 minutes
-                mc.set('group_data', groups, 900)
-
-            return dict(success=True, data=groups)
-        elif data == 'user_data':
-            people = {}
-            people_list = select([
-                PeopleTable.c.id,
-                PeopleTable.c.username,
-                PeopleTable.c.password,
-                PeopleTable.c.human_name,
-                PeopleTable.c.ssh_key,
-                PeopleTable.c.email,
-                PeopleTable.c.privacy,
-                PeopleTable.c.alias_enabled
-                ], PeopleTable.c.status == 'active').execute()
-            for id, username, password, human_name, ssh_key, email, privacy, alias_enabled in people_list:
-                people[id] = {
-                    'username': username,
-                    'password': password,
-                    'human_name': human_name,
-                    'ssh_key': ssh_key,
-                    'email': email,
-                    'alias_enabled': alias_enabled
-                }
-
-                if privacy:
-                    # If they have privacy enabled, set their human_name to
-                    # their username
-                    people[id]['human_name'] = username
-
-                if not privs['system']:
-                    people[id]['password'] = '*'
-                if not privs['thirdparty']:
-                    people[id]['ssh_key'] = ''
-            return dict(success=True, data=people)
-        return dict(success=False, data={})
+            # The token is stored with the groups so clients that sync
+            # incrementally afterwards start from what they were given.
+            token, groups = group_data_cache.get(
+                    lambda: (token, build_group_data()),
+                    force_refresh=bool(force_refresh))
+            return stream_json([('success', True), ('token', token),
+                ('full', True), ('data', JsonObject(groups.iteritems()))])
+
+        if privs['system']:
+            tier = 'system'
+        elif privs['thirdparty']:
+            tier = 'thirdparty'
+        else:
+            tier = 'plain'
+        token, people = user_data_caches[tier].get(
+                lambda: (token, build_user_data(privs)),
+                force_refresh=bool(force_refresh))
+        # This is the largest response we send.  Encode it a piece at a
+        # time instead of into one string.
+        return stream_json([('success', True), ('token', token),
+            ('full', True), ('data', JsonObject(people.iteritems()))])
 
     @identity.require(turbogears.identity.not_anonymous())
     @expose("json", allow_json=True)
@@ -169,6 +347,54 @@ class JsonRequest(controllers.Controller):
         except InvalidRequestError:
             return dict(success=False)
 
+    @identity.require(turbogears.identity.not_anonymous())
+    @expose("json", allow_json=True)
+    def people_by_ids(self, ids=None):
+        '''Return several people by id.
+
+        This gives the same information as :meth:`person_by_id` for up to
+        ``json.max_people`` people in one request.
+
+        :kwarg ids: Comma separated list of ids.  The parameter may also be
+            given several times.
+        :returns: dict with ``people`` mapping id to person and
+            ``unknown``, the ids that were not found
+        '''
+        try:
+            ids = [int(i) for i in split_list(ids)]
+        except ValueError:
+            return dict(success=False, error='Invalid id specified.',
+                    people={})
+        if len(ids) > int(config.get('json.max_people', 1000)):
+            return dict(success=False, error='Too many people requested.',
+                    people={})
+        people = dict((p['id'], p) for p in lookup_people(PeopleTable.c.id,
+            ids))
+        unknown = [i for i in ids if i not in people]
+        return dict(success=True, people=people, unknown=unknown)
+
+    @identity.require(turbogears.identity.not_anonymous())
+    @expose("json", allow_json=True)
+    def people_by_usernames(self, usernames=None):
+        '''Return several people by username.
+
+        This gives the same information as :meth:`person_by_username` for up
+        to ``json.max_people`` people in one request.
+
+        :kwarg usernames: Comma separated list of usernames.  The parameter
+            may also be given several times.
+        :returns: dict with ``people`` mapping username to person and
+            ``unknown``, the usernames that were not found
+        '''
+        usernames = split_list(usernames)
+        if len(usernames) > int(config.get('json.max_people', 1000)):
+            return dict(success=False, error='Too many people requested.',
+                    people={})
+        people = dict((p['username'], p) for p in lookup_people(
+            PeopleTable.c.username, usernames))
+        unknown = [u for u in usernames if u not in people]
+        return dict(success=True, people=people, unknown=unknown)
+
     @identity.require(turbogears.identity.not_anonymous())
     @expose("json", allow_json=True)
     def group_by_id(self, group_id):
@@ -201,9 +427,43 @@ class JsonRequest(controllers.Controller):
             people[person[0]] = person[1]
         return dict(people=people)
 
+    @identity.require(identity.in_group(config.get('admingroup', 'accounts')))
+    @expose("json", allow_json=True)
+    def sql_report(self):
+        '''Report the SQL statements run by each controller method.
+
+        The numbers cover the requests served by this process since it
+        started.
+
+        :returns: dict with ``methods``, a list of dicts with the number of
+            requests, statements and seconds spent in the database for each
+            controller method, and ``avoided_queries``, the lookups per
+            controller method answered without asking the database.
+        '''
+        return dict(methods=sql_report(), avoided_queries=avoided_queries)
+
     @identity.require(turbogears.identity.not_anonymous())
     @expose("json", allow_json=True)
-    def people_query(self, columns=None, **constraints):
+    def people_query(self, columns=None, after=None, limit=None,
+            output=None, **constraints):
+        '''Query people, their roles and groups.
+
+        Constraints are given as extra parameters.  ``column=pattern``
+        matches with SQL LIKE, ``column__eq=value`` matches exactly and
+        ``column__in=value1,value2`` matches any of a list of values.
+
+        :kwarg columns: Comma separated list of the columns to return
+        :kwarg after: Only return people whose username sorts after this.
+            Pass the ``next`` value of a previous response to get the
+            following page.
+        :kwarg limit: Return the rows of at most this many people
+        :kwarg output: 'ndjson' to stream one row per line instead of
+            returning a single JSON document.  Unless `limit` is given every
+            matching row is sent.
+        :returns: dict with ``data``, a list of rows, and when `after` or
+            `limit` is given ``next``, the value of `after` for the next
+            page or None on the last page.
+        '''
         people_columns = [c.name for c in PeopleTable.columns]
 
         # Queryable columns are temporarily limited until
@@ -236,28 +496,89 @@ class JsonRequest(controllers.Controller):
             # By default, return all of the people columns in column_map.
             cols = [c for c in people_columns if c in column_map]
 
-        print cols
-        print constraints
-
-        groupjoin = []
-        if 'group' in constraints \
-            or 'group_type' in constraints \
-            or 'role_status' in constraints \
-            or 'role_type' in constraints:
-            groupjoin = [PeopleTable.join(PersonRolesTable,
-                PersonRolesTable.c.person_id == PeopleTable.c.id).join(GroupsTable,
-                GroupsTable.c.id == PersonRolesTable.c.group_id)]
-
         try:
-            query = select([column_map[c] for c in cols], from_obj=groupjoin)
+            selected = [column_map[c] for c in cols]
         except KeyError:
             return dict(success=False, error='Invalid column requested.', data={})
 
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                return dict(success=False, error='Invalid limit specified.',
+                        data={})
+            if limit < 1:
+                return dict(success=False, error='Invalid limit specified.',
+                        data={})
+
+        need_groups = [c for c in selected if c.table is not PeopleTable]
+        clauses = []
         for k, v in constraints.iteritems():
-            if k not in column_map:
+            name, match = k, 'like'
+            if '__' in k:
+                name, match = k.rsplit('__', 1)
+            if name not in column_map or match not in ('like', 'eq', 'in'):
                 return dict(success=False,
                 error='Invalid constraint specified.', data={})
-            query = query.where(column_map[k].like(v))
+            column = column_map[name]
+            if column.table is not PeopleTable:
+                need_groups.append(column)
+            if match == 'in':
+                clauses.append(column.in_(split_list(v)))
+            elif match == 'eq':
+                clauses.append(column == v)
+            else:
+                clauses.append(column.like(v))
+
+        groupjoin = []
+        if need_groups:
+            groupjoin = [PeopleTable.join(PersonRolesTable,
+                PersonRolesTable.c.person_id == PeopleTable.c.id).join(GroupsTable,
+                GroupsTable.c.id == PersonRolesTable.c.group_id)]
 
-        results = [dict(zip(cols, r)) for r in query.execute()]
-        return dict(success=True, data=results)
+        def query_rows(usernames=None):
+            query = select(selected, from_obj=groupjoin)
+            for clause in clauses:
+                query = query.where(clause)
+            if usernames is not None:
+                query = query.where(PeopleTable.c.username.in_(usernames))\
+                        .order_by(PeopleTable.c.username)
+            return [dict(zip(cols, r)) for r in query.execute()]
+
+        def query_page(after, count):
+            # Pick the people on the page first so that all of a person's
+            # rows end up on the same page.
+            query = select([PeopleTable.c.username], from_obj=groupjoin)\
+                    .distinct()
+            for clause in clauses:
+                query = query.where(clause)
+            if after is not None:
+                query = query.where(PeopleTable.c.username > after)
+            usernames = [r[0] for r in query.order_by(
+                PeopleTable.c.username).limit(count).execute()]
+            if not usernames:
+                return usernames, []
+            return usernames, query_rows(usernames)
+
+        if output == 'ndjson':
+            def all_rows(after):
+                batch_size = limit or int(config.get('json.batch_size', 1000))
+                while True:
+                    usernames, results = query_page(after, batch_size)
+                    for row in results:
+                        yield row
+                    if limit or len(usernames) < batch_size:
+                        break
+                    after = usernames[-1]
+            return stream_ndjson(all_rows(after))
+
+        if after is None and limit is None:
+            return dict(success=True, data=query_rows())
+
+        if limit is None:
+            limit = int(config.get('json.batch_size', 1000))
+        usernames, results = query_page(after, limit)
+        next_after = None
+        if len(usernames) == limit:
+            next_after = usernames[-1]
+        return dict(success=True, data=results, next=next_after)
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+'''
+Send large JSON responses a piece at a time.
+
+The json view encodes the whole dict a controller returns into one string.
+For listings of every account or group that means holding both the data and
+its encoding in memory.  Controllers can instead return
+:func:`stream_json` with :class:`JsonObject` and :class:`JsonArray` values
+that wrap iterators.  Those are encoded as they are consumed.
+
+Result sets that are better consumed a row at a time can be sent as
+newline delimited JSON with :func:`stream_ndjson`.
+
+To have CherryPy send the pieces as they are produced instead of joining
+them, turn on ``stream_response`` for the path in the config file.
+'''
+
+import tempfile
+
+import cherrypy
+from turbogears import config
+
+from fas.records import Record
+
+try:
+    from turbojson.jsonify import encode
+except ImportError:
+    from turbogears.jsonify import encode
+
+class JsonObject(object):
+    '''A JSON object whose members are produced by an iterator.
+
+    :arg pairs: iterable of (key, value) pairs
+    '''
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+class JsonArray(object):
+    '''A JSON array whose elements are produced by an iterator.
+
+    :arg values: iterable of values
+    '''
+    def __init__(self, values):
+        self.values = values
+
+def _encode_pieces(value):
+    '''Yield the JSON encoding of `value` in pieces.'''
+    if isinstance(value, JsonObject):
+        yield '{'
+        first = True
+        for key, item in value.pairs:
+            if first:
+                first = False
+            else:
+                yield ', '
+            # Like the json view, keys are always sent as strings
+            yield encode(unicode(key))
+            yield ': '
+            for piece in _encode_pieces(item):
+                yield piece
+        yield '}'
+    elif isinstance(value, Record):
+        # Skip building the dict that __json__ would return
+        yield '{'
+        first = True
+        for field in value.fields:
+            if first:
+                first = False
+            else:
+                yield ', '
+            yield encode(field)
+            yield ': '
+            for piece in _encode_pieces(getattr(value, field)):
+                yield piece
+        yield '}'
+    elif isinstance(value, (list, tuple)):
+        yield '['
+        first = True
+        for item in value:
+            if first:
+                first = False
+            else:
+                yield ', '
+            for piece in _encode_pieces(item):
+                yield piece
+        yield ']'
+    elif isinstance(value, JsonArray):
+        yield '['
+        first = True
+        for item in value.values:
+            if first:
+                first = False
+            else:
+                yield ', '
+            for piece in _encode_pieces(item):
+                yield piece
+        yield ']'
+    else:
+        yield encode(value)
+
+def iter_json(value, chunk_size=None):
+    '''Encode `value` to JSON, yielding chunks of about `chunk_size` bytes.
+
+    :arg value: Value to encode.  May contain :class:`JsonObject` and
+        :class:`JsonArray` instances.
+    :kwarg chunk_size: Bytes to gather before yielding.  Defaults to the
+        ``json.chunk_size`` config value.
+    '''
+    if chunk_size is None:
+        chunk_size = int(config.get('json.chunk_size', 65536))
+    buf = []
+    size = 0
+    for piece in _encode_pieces(value):
+        if isinstance(piece, unicode):
+            piece = piece.encode('utf-8')
+        buf.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield ''.join(buf)
+
+class SpooledArray(object):
+    '''A JSON array written to a temporary file.
+
+    Useful when two arrays are produced by one pass over the data but have
+    to be sent one after the other: the first is streamed while the second
+    is appended here.
+    '''
+    def __init__(self):
+        self.spool = tempfile.TemporaryFile()
+        self.spool.write('[')
+        self.count = 0
+
+    def append(self, value):
+        '''Encode `value` onto the end of the array.'''
+        if self.count:
+            self.spool.write(', ')
+        for chunk in iter_json(value):
+            self.spool.write(chunk)
+        self.count += 1
+
+    def chunks(self, chunk_size=None):
+        '''Yield the encoded array and close the file.'''
+        if chunk_size is None:
+            chunk_size = int(config.get('json.chunk_size', 65536))
+        try:
+            self.spool.write(']')
+            self.spool.seek(0)
+            while True:
+                chunk = self.spool.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.spool.close()
+
+def stream_json(members):
+    '''Return a streamed JSON response from a controller.
+
+    :arg members: iterable of (key, value) pairs making up the top level
+        JSON object.  Values may be :class:`JsonObject`,
+        :class:`JsonArray` or :class:`SpooledArray` instances.
+    :returns: a generator of body chunks to return from the controller
+    '''
+    cherrypy.response.headers['Content-Type'] = 'application/json'
+    return _stream_members(members)
+
+def _stream_members(members):
+    yield '{'
+    first = True
+    for key, value in members:
+        if first:
+            first = False
+        else:
+            yield ', '
+        yield encode(unicode(key)).encode('utf-8') + ': '
+        if isinstance(value, SpooledArray):
+            for chunk in value.chunks():
+                yield chunk
+        else:
+            for chunk in iter_json(value):
+                yield chunk
+    yield '}'
+
+def stream_ndjson(values):
+    '''Return a newline delimited JSON response from a controller.
+
+    :arg values: iterable of values to send, one per line
+    :returns: a generator of body chunks to return from the controller
+    '''
+    cherrypy.response.headers['Content-Type'] = 'application/x-ndjson'
+    return _stream_lines(values)
+
+def _stream_lines(values, chunk_size=None):
+    if chunk_size is None:
+        chunk_size = int(config.get('json.chunk_size', 65536))
+    buf = []
+    size = 0
+    for value in values:
+        line = encode(value)
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        buf.append(line)
+        buf.append('\n')
+        size += len(line) + 1
+        if size >= chunk_size:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield ''.join(buf)
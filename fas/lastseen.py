@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+'''
+Write-behind buffer for people's last_seen times.
+
+Logins and the services reporting activity used to update the people row
+right away.  :func:`seen` only notes the latest time for each person.  The
+notes are written with one batched UPDATE ``last_seen.flush_interval``
+seconds after the first of them, by a timer so they are written even when
+no more requests come in, or as soon as ``last_seen.max_pending`` people are
+waiting, and when the server shuts down.  last_seen never moves
+backwards.
+'''
+
+import time
+import threading
+
+from sqlalchemy.sql import and_, or_, bindparam
+import turbogears.startup as startup
+from turbogears import config
+
+from fas.model import PeopleTable
+
+import logging
+log = logging.getLogger('fas.lastseen')
+
+pending = {}
+pending_lock = threading.Lock()
+last_flush = [time.time()]
+# Flushes the pending times once the interval has passed
+flush_timer = [None]
+
+def seen(person_id, when):
+    '''Note that a person was seen.
+
+    :arg person_id: id of the person
+    :arg when: datetime they were seen at
+    '''
+    interval = int(config.get('last_seen.flush_interval', 60))
+    pending_lock.acquire()
+    try:
+        if person_id not in pending or pending[person_id] < when:
+            pending[person_id] = when
+        due = len(pending) >= int(config.get('last_seen.max_pending', 1000)) \
+                or time.time() - last_flush[0] >= interval
+        if not due and flush_timer[0] is None:
+            # mod_wsgi does not reliably run the shutdown hooks when it
+            # recycles a process, so do not leave times waiting for them
+            timer = flush_timer[0] = threading.Timer(interval, flush)
+            timer.setDaemon(True)
+            timer.start()
+    finally:
+        pending_lock.release()
+    if due:
+        flush()
+
+def flush():
+    '''Write the pending last_seen times to the database.'''
+    pending_lock.acquire()
+    try:
+        updates = pending.items()
+        pending.clear()
+        last_flush[0] = time.time()
+        timer = flush_timer[0]
+        flush_timer[0] = None
+    finally:
+        pending_lock.release()
+    if timer is not None and timer is not threading.currentThread():
+        timer.cancel()
+    if not updates:
+        return
+    statement = PeopleTable.update(and_(
+        PeopleTable.c.id == bindparam('person_id'),
+        or_(PeopleTable.c.last_seen == None,
+            PeopleTable.c.last_seen < bindparam('seen'))),
+        values={PeopleTable.c.last_seen: bindparam('seen')})
+    try:
+        statement.execute([dict(person_id=person_id, seen=when)
+            for person_id, when in updates])
+    except Exception, e:
+        # Losing some last_seen times is better than failing the request
+        log.error('Could not update last_seen for %d people: %s' %
+                (len(updates), e))
+
+startup.call_on_shutdown.append(flush)
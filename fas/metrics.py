@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+'''
+Metrics in the Prometheus text format.
+
+Counters and histograms are plain dicts updated without locks: under the
+GIL an increment can very rarely be lost, which is fine for monitoring and
+keeps the cost to a couple of dict operations.
+
+mod_wsgi runs several processes.  When ``metrics.dir`` is set each of them
+writes its numbers to a file there every ``metrics.flush_interval``
+seconds and /metrics adds up the files of all of them.  Gauges are only
+taken from the processes that are still running.  The counters and
+histograms of processes that exited are folded into one file so the
+directory does not grow as mod_wsgi recycles its processes.
+'''
+
+import errno
+import fcntl
+import marshal
+import os
+import re
+import tempfile
+import time
+
+import cherrypy
+from turbogears import config
+
+from fas.sqlstats import handler_name
+
+import logging
+log = logging.getLogger('fas.metrics')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+        10.0, 30.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+# (name, labels) -> value
+counters = {}
+# (name, labels) -> [count in each bucket..., count, sum]
+histograms = {}
+# name -> bucket bounds
+bucket_bounds = {}
+# name -> function returning the current value
+gauge_functions = {}
+# name -> (type, help)
+descriptions = {}
+
+last_dump = [0]
+
+# Numbers of the processes that exited, in metrics.dir
+EXITED_FILE = 'exited.data'
+EXITED_LOCK = 'exited.lock'
+
+def describe(name, kind, text):
+    '''Set the type and help text shown for the metric `name`.'''
+    descriptions[name] = (kind, text)
+
+def inc(name, labels=(), amount=1):
+    '''Add `amount` to a counter.
+
+    :arg name: Name of the counter
+    :kwarg labels: tuple of (label, value) pairs
+    :kwarg amount: How much to add
+    '''
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + amount
+
+def observe(name, value, labels=(), buckets=LATENCY_BUCKETS):
+    '''Record `value` in a histogram.
+
+    :arg name: Name of the histogram
+    :arg value: The observed value
+    :kwarg labels: tuple of (label, value) pairs
+    :kwarg buckets: Upper bounds of the buckets, used the first time the
+        histogram is seen
+    '''
+    key = (name, labels)
+    entry = histograms.get(key)
+    if entry is None:
+        buckets = bucket_bounds.setdefault(name, buckets)
+        entry = histograms[key] = [0] * (len(buckets) + 2)
+    else:
+        buckets = bucket_bounds[name]
+    for index, bound in enumerate(buckets):
+        if value <= bound:
+            entry[index] += 1
+            break
+    entry[-2] += 1
+    entry[-1] += value
+
+def gauge(name, function):
+    '''Report the value returned by `function` as the gauge `name`.'''
+    gauge_functions[name] = function
+
+def snapshot():
+    '''Return the numbers of this process in the format of the files.'''
+    gauges = {}
+    for name, function in gauge_functions.items():
+        try:
+            value = function()
+        except Exception, e:
+            log.debug('Could not read %s: %s' % (name, e))
+            continue
+        if value is not None:
+            gauges[name] = value
+    return dict(pid=os.getpid(), counters=dict(counters),
+            histograms=dict((key, list(value))
+                for key, value in histograms.items()),
+            buckets=dict(bucket_bounds), gauges=gauges)
+
+def dump():
+    '''Write the numbers of this process to ``metrics.dir``.'''
+    directory = config.get('metrics.dir')
+    last_dump[0] = time.time()
+    if not directory:
+        return
+    try:
+        _write(directory, '%d.metrics' % os.getpid(), snapshot())
+    except (IOError, OSError), e:
+        log.warning('Could not write metrics: %s' % e)
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        # Processes of somebody else are still running
+        return e.errno == errno.EPERM
+    return True
+
+def _read(filename):
+    data_file = open(filename, 'rb')
+    try:
+        return marshal.loads(data_file.read())
+    finally:
+        data_file.close()
+
+def _write(directory, filename, data):
+    fd, name = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    try:
+        os.write(fd, marshal.dumps(data))
+    finally:
+        os.close(fd)
+    os.rename(name, os.path.join(directory, filename))
+
+def _add(total, data):
+    '''Add the counters and histograms of the snapshot `data` to `total`.'''
+    for key, value in data['counters'].items():
+        total['counters'][key] = total['counters'].get(key, 0) + value
+    total['buckets'].update(data['buckets'])
+    for key, value in data['histograms'].items():
+        entry = total['histograms'].get(key)
+        if entry is None:
+            total['histograms'][key] = list(value)
+        else:
+            for index, item in enumerate(value):
+                entry[index] += item
+
+def _empty():
+    return dict(pid=None, counters={}, histograms={}, buckets={}, gauges={})
+
+def _fold_exited(directory, filenames):
+    '''Add the files of exited processes to the exited file and remove them.'''
+    lock = open(os.path.join(directory, EXITED_LOCK), 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        exited_name = os.path.join(directory, EXITED_FILE)
+        try:
+            exited = _read(exited_name)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                raise
+            exited = _empty()
+        folded = []
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            try:
+                _add(exited, _read(path))
+            except (IOError, OSError), e:
+                # Folded by somebody else in the meantime
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            except (ValueError, EOFError), e:
+                log.warning('Dropping unreadable metrics %s: %s'
+                        % (filename, e))
+            folded.append(path)
+        if folded:
+            _write(directory, EXITED_FILE, exited)
+            for path in folded:
+                os.remove(path)
+    finally:
+        lock.close()
+
+def collect():
+    '''Return the snapshots of every process, this one included.
+
+    The numbers of processes that exited are returned as one snapshot
+    without a pid.
+    '''
+    dump()
+    directory = config.get('metrics.dir')
+    if not directory:
+        return [snapshot()]
+    exited = []
+    for filename in os.listdir(directory):
+        if not filename.endswith('.metrics'):
+            continue
+        try:
+            pid = int(filename[:-len('.metrics')])
+        except ValueError:
+            continue
+        if pid != os.getpid() and not _running(pid):
+            exited.append(filename)
+    if exited:
+        try:
+            _fold_exited(directory, exited)
+        except (IOError, OSError), e:
+            log.warning('Could not fold the metrics of exited processes: %s'
+                    % e)
+
+    snapshots = []
+    for filename in os.listdir(directory):
+        if not filename.endswith('.metrics') and filename != EXITED_FILE:
+            continue
+        try:
+            snapshots.append(_read(os.path.join(directory, filename)))
+        except (IOError, OSError, ValueError, EOFError), e:
+            log.warning('Could not read metrics from %s: %s' % (filename, e))
+    return snapshots
+
+_escape_re = re.compile(r'(["\\\n])')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (label,
+        _escape_re.sub(lambda m: m.group(1) == '\n' and '\\n' or
+            '\\' + m.group(1), unicode(value)))
+        for label, value in labels)
+
+def _header(lines, name, default_kind):
+    kind, text = descriptions.get(name, (default_kind, name))
+    lines.append('# HELP %s %s' % (name, text))
+    lines.append('# TYPE %s %s' % (name, kind))
+
+def render():
+    '''Return every metric added up over the processes in text format.'''
+    total = _empty()
+    total_gauges = {}
+    for data in collect():
+        _add(total, data)
+        if data['pid'] is not None and (data['pid'] == os.getpid()
+                or _running(data['pid'])):
+            for name, value in data['gauges'].items():
+                total_gauges[name] = total_gauges.get(name, 0) + value
+    total_counters = total['counters']
+    total_histograms = total['histograms']
+    buckets = total['buckets']
+
+    lines = []
+    by_name = {}
+    for (name, labels), value in total_counters.items():
+        by_name.setdefault(name, []).append((labels, value))
+    for name in sorted(by_name):
+        _header(lines, name, 'counter')
+        for labels, value in sorted(by_name[name]):
+            lines.append('%s%s %s' % (name, _format_labels(labels), value))
+
+    by_name = {}
+    for (name, labels), value in total_histograms.items():
+        by_name.setdefault(name, []).append((labels, value))
+    for name in sorted(by_name):
+        _header(lines, name, 'histogram')
+        for labels, value in sorted(by_name[name]):
+            cumulative = 0
+            for bound, count in zip(buckets[name], value):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name,
+                    _format_labels(labels + (('le', repr(float(bound))),)),
+                    cumulative))
+            lines.append('%s_bucket%s %d' % (name,
+                _format_labels(labels + (('le', '+Inf'),)), value[-2]))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels),
+                value[-2]))
+            lines.append('%s_sum%s %r' % (name, _format_labels(labels),
+                value[-1]))
+
+    for name in sorted(total_gauges):
+        _header(lines, name, 'gauge')
+        lines.append('%s %s' % (name, total_gauges[name]))
+    return u'\n'.join(lines).encode('utf-8') + '\n'
+
+describe('fas_request_duration_seconds', 'histogram',
+        'Time taken to answer requests, per controller method')
+describe('fas_response_size_bytes', 'histogram',
+        'Size of the responses with a known length, per controller method')
+
+class MetricsFilter(object):
+    '''CherryPy filter timing every request.'''
+    def on_start_resource(self):
+        cherrypy.request.fas_started = time.time()
+
+    def on_end_request(self):
+        started = getattr(cherrypy.request, 'fas_started', None)
+        if started is None:
+            return
+        now = time.time()
+        labels = (('method', handler_name()),)
+        observe('fas_request_duration_seconds', now - started, labels)
+        length = cherrypy.response.headers.get('Content-Length')
+        if length:
+            observe('fas_response_size_bytes', int(length), labels,
+                    buckets=SIZE_BUCKETS)
+        if now - last_dump[0] >= int(config.get('metrics.flush_interval',
+                10)):
+            dump()
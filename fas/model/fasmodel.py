@@ -31,6 +31,7 @@ import pytz
 from turbogears.database import metadata, mapper, get_engine, session
 from turbogears import identity, config
 import turbogears
+import cherrypy
 
 from sqlalchemy import Table, Column, ForeignKey, Sequence
 from sqlalchemy import String, Integer, DateTime, Boolean
@@ -48,6 +49,12 @@ from fedora.client import DictContainer
 from fedora.tg.json import SABase
 import fas
 from fas import SHARE_CC_GROUP, SHARE_LOC_GROUP
+from fas.cache import invalidate
+from fas.sqlstats import QueryStats, handler_name
+
+# Count the statements each request runs (see fas.sqlstats)
+if config.get('sql_stats.on', True):
+    config.update({'sqlalchemy.proxy': QueryStats()})
 
 # Bind us to the database defined in the config file.
 get_engine()
@@ -66,6 +73,8 @@ LogTable = Table('log', metadata, autoload=True)
 RequestsTable = Table('requests', metadata, autoload=True)
 
 SessionTable = Table('session', metadata, autoload=True)
+SyncChangesTable = Table('sync_changes', metadata, autoload=True)
+RevokedTokensTable = Table('revoked_tokens', metadata, autoload=True)
 
 #
 # Selects for filtering roles
@@ -100,6 +109,100 @@ serial_seq = Sequence('serial_seq')
 # Mapped Classes
 #
 
+#
+# Lookups already made while handling the current request
+#
+
+# Number of lookups answered from the request cache, per controller method
+# (named like fas.sqlstats.handler_name), in this process
+avoided_queries = {}
+
+def request_lookups():
+    '''Return the objects looked up by key during the current request.
+
+    :returns: dict mapping (class name, attribute, value) to the object or
+        None when called outside of a request, for instance from a script.
+    '''
+    try:
+        request = cherrypy.request
+        lookups = getattr(request, 'fas_lookups', None)
+        if lookups is None:
+            lookups = request.fas_lookups = {}
+            request.fas_avoided_queries = 0
+    except AttributeError:
+        return None
+    return lookups
+
+def remember(obj, *attributes):
+    '''Let lookups of `obj` by `attributes` in this request reuse it.'''
+    lookups = request_lookups()
+    if lookups is not None:
+        name = obj.__class__.__name__
+        for attribute in attributes:
+            lookups[(name, attribute, getattr(obj, attribute))] = obj
+
+def forget(obj, *attributes):
+    '''Drop `obj` from the lookups of this request.'''
+    lookups = request_lookups()
+    if lookups is not None:
+        name = obj.__class__.__name__
+        for attribute in attributes:
+            lookups.pop((name, attribute, getattr(obj, attribute)), None)
+
+def lookup(cls, attribute, value, attributes):
+    '''Find the `cls` whose `attribute` is `value`.
+
+    Objects already found during this request are returned without asking
+    the database again.
+
+    :arg cls: Mapped class to look in
+    :arg attribute: Unique attribute to search by
+    :arg value: Value to search for
+    :arg attributes: All the unique attributes objects are remembered by
+    :raises InvalidRequestError: if no such object exists
+    '''
+    lookups = request_lookups()
+    if lookups is not None:
+        obj = lookups.get((cls.__name__, attribute, value))
+        if obj is not None:
+            request = cherrypy.request
+            request.fas_avoided_queries += 1
+            name = getattr(request, 'fas_handler_name', None)
+            if name is None:
+                name = request.fas_handler_name = handler_name()
+            avoided_queries[name] = avoided_queries.get(name, 0) + 1
+            return obj
+    obj = cls.query.filter_by(**{attribute: value}).one()
+    remember(obj, *attributes)
+    return obj
+
+def request_role_maps():
+    '''Return the role maps loaded by :mod:`fas.auth` during this request.
+
+    :returns: dict or None when called outside of a request
+    '''
+    try:
+        request = cherrypy.request
+        maps = getattr(request, 'fas_role_maps', None)
+        if maps is None:
+            maps = request.fas_role_maps = {}
+    except AttributeError:
+        return None
+    return maps
+
+def forget_role_maps():
+    '''Drop the role maps of this request after memberships changed.'''
+    try:
+        cherrypy.request.fas_role_maps = {}
+    except AttributeError:
+        pass
+
+def memberships_changed():
+    '''Drop cached information that depends on group memberships.'''
+    invalidate('group_data')
+    invalidate('identity')
+    forget_role_maps()
+
 admin_group = config.get('admingroup', 'accounts')
 system_group = config.get('systemgroup', 'fas-system')
 thirdparty_group = config.get('thirdpartygroup', 'thirdparty')
@@ -163,7 +266,7 @@ class People(SABase):
         A class method that can be used to search users
         based on their unique id
         '''
-        return cls.query.filter_by(id=id).one()
+        return lookup(cls, 'id', id, ('id', 'username'))
 
     @classmethod
     def by_email_address(cls, email):
@@ -179,7 +282,7 @@ class People(SABase):
         A class method that permits to search users
         based on their username attribute.
         '''
-        return cls.query.filter_by(username=username).one()
+        return lookup(cls, 'username', username, ('id', 'username'))
 
     # If we're going to do logging here, we'll have to pass the person that did the applying.
     def apply(cls, group, requester):
@@ -194,6 +297,7 @@ class People(SABase):
             role.role_type = 'user'
             role.member = cls
             role.group = group
+            memberships_changed()
 
     def upgrade(cls, group, requester):
         '''
@@ -209,6 +313,7 @@ class People(SABase):
                 role.role_type = 'administrator'
             elif role.role_type == 'user':
                 role.role_type = 'sponsor'
+            memberships_changed()
 
     def downgrade(cls, group, requester):
         '''
@@ -224,6 +329,7 @@ class People(SABase):
                 role.role_type = 'user'
             elif role.role_type == 'administrator':
                 role.role_type = 'sponsor'
+            memberships_changed()
 
     def sponsor(cls, group, requester):
         # If we want to do logging, this might be the place.
@@ -233,6 +339,7 @@ class People(SABase):
         role.role_status = 'approved'
         role.sponsor = requester
         role.approval = datetime.now(pytz.utc)
+        memberships_changed()
         cls._handle_auto_add(group, requester)
 
     def _handle_auto_add(cls, group, requester):
@@ -268,6 +375,7 @@ class People(SABase):
             role.sponsor = requester
             role.role_status = 'approved'
             role.approval = datetime.now(pytz.utc)
+        memberships_changed()
 
     def remove(cls, group, requester):
         if not group in cls.memberships:
@@ -275,6 +383,7 @@ class People(SABase):
         else:
             role = PersonRoles.query.filter_by(member=cls, group=group).one()
             session.delete(role)
+            memberships_changed()
 
     def set_share_cc(self, value):
         share_cc_group = Groups.by_name(SHARE_CC_GROUP)
@@ -408,7 +517,7 @@ class Groups(SABase):
         A class method that can be used to search groups
         based on their unique id
         '''
-        return cls.query.filter_by(id=group_id).one()
+        return lookup(cls, 'id', group_id, ('id', 'name'))
 
     @classmethod
     def by_email_address(cls, email):
@@ -432,12 +541,15 @@ class Groups(SABase):
         A class method that permits to search groups
         based on their name attribute.
         '''
-        return cls.query.filter_by(name=name).one()
+        return lookup(cls, 'name', name, ('id', 'name'))
 
     def delete(cls):
         for role in cls.roles:
             session.delete(role)
         session.delete(cls)
+        forget(cls, 'id', 'name')
+        memberships_changed()
+        invalidate('groups')
 
     def __repr__(cls):
         return "Groups(%s,%s)" % (cls.name, cls.display_name)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+'''
+Client for the yk-val server that checks yubikey one time passwords.
+
+Both password+OTP logins and the yubikey plugin self test go through
+:func:`verify_otp`.  Connections to the validation server are kept open
+and reused between requests, and every request is bounded by
+``yubi_timeout`` seconds so that a slow validator can't tie up a worker
+for good.  The yubikey settings of each person are cached as well.
+'''
+
+import httplib
+import re
+import socket
+import threading
+import urllib
+import urlparse
+
+from turbogears import config
+
+from fas.cache import SharedCache
+from fas.model import Configs
+
+import logging
+log = logging.getLogger('fas.otp')
+
+class OtpError(Exception):
+    '''The validation server could not be asked.'''
+    pass
+
+status_re = re.compile('^status=(?P<rc>\w+)')
+
+class OtpClient(object):
+    '''Pool of keep-alive connections to a yk-val server.
+
+    :arg url: The verify URL up to and including the ``id=`` parameter
+    :kwarg client_id: Client id to send
+    :kwarg timeout: Seconds to wait for the server on each request
+    :kwarg pool_size: Most idle connections to keep around
+    '''
+    def __init__(self, url, client_id='1', timeout=5, pool_size=4):
+        parts = urlparse.urlsplit(url)
+        if parts[0] == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.netloc = parts[1]
+        self.path = url[url.index(parts[1]) + len(parts[1]):] or '/'
+        self.client_id = client_id
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _connection(self):
+        self.lock.acquire()
+        try:
+            if self.idle:
+                return self.idle.pop(), True
+        finally:
+            self.lock.release()
+        return self.connection_class(self.netloc, timeout=self.timeout), False
+
+    def _release(self, connection):
+        self.lock.acquire()
+        try:
+            if len(self.idle) < self.pool_size:
+                self.idle.append(connection)
+                return
+        finally:
+            self.lock.release()
+        connection.close()
+
+    def close(self):
+        '''Close the idle connections.'''
+        self.lock.acquire()
+        try:
+            for connection in self.idle:
+                connection.close()
+            self.idle = []
+        finally:
+            self.lock.release()
+
+    def status(self, otp):
+        '''Ask the server about `otp`.
+
+        :arg otp: The one time password
+        :returns: the status the server answered with, for instance 'OK' or
+            'REPLAYED_OTP'
+        :raises OtpError: if the server could not be reached in time or gave
+            an answer without a status
+        '''
+        url = self.path + urllib.quote(self.client_id) + '&otp=' + \
+                urllib.quote(otp)
+        while True:
+            connection, reused = self._connection()
+            try:
+                connection.request('GET', url)
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                if reused and not isinstance(e, socket.timeout):
+                    # The server may have closed an idle connection
+                    continue
+                raise OtpError(str(e) or e.__class__.__name__)
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            break
+
+        for line in body.splitlines():
+            match = status_re.search(line.strip())
+            if match:
+                return match.group('rc')
+        raise OtpError('No status in the answer of the validation server')
+
+client = None
+client_lock = threading.Lock()
+
+def otp_client():
+    '''Return the OtpClient for the configured validation server.'''
+    global client
+    if client is None:
+        client_lock.acquire()
+        try:
+            if client is None:
+                client = OtpClient(config.get('yubi_server_prefix',
+                    'http://localhost/yk-val/verify?id='),
+                    timeout=float(config.get('yubi_timeout', 5)),
+                    pool_size=int(config.get('yubi_pool_size', 4)))
+        finally:
+            client_lock.release()
+    return client
+
+# Yubikey settings of each person, invalidated when someone changes theirs
+yubikey_cache = SharedCache('yubikey', 'yubikey',
+        ttl=int(config.get('yubi_cache_ttl', 300)))
+
+def yubikey_configs(person_id):
+    '''Return the yubikey settings of a person.
+
+    :arg person_id: id of the person
+    :returns: dict of the person's yubikey Configs.  ``enabled`` and
+        ``prefix`` are always present; prefix is None when not set.
+    '''
+    configs = yubikey_cache.get(person_id)
+    if configs is None:
+        configs = {'enabled': '0', 'prefix': None}
+        for setting in Configs.query.filter_by(person_id=person_id,
+                application='yubikey'):
+            configs[setting.attribute] = setting.value
+        yubikey_cache.set(person_id, configs)
+    return configs
+
+def verify_otp(person_id, otp):
+    '''Check a one time password of a person.
+
+    :arg person_id: id of the person
+    :arg otp: The one time password
+    :returns: 'OK' if the OTP is valid.  Otherwise the reason it was
+        refused: 'BAD_PREFIX' when it doesn't come from the person's
+        yubikey, the status given by the validation server or 'ERROR' when
+        the server couldn't be asked.
+    '''
+    prefix = yubikey_configs(person_id)['prefix']
+    if not prefix or not otp.startswith(prefix):
+        return 'BAD_PREFIX'
+    try:
+        return otp_client().status(otp)
+    except OtpError, e:
+        log.error('Could not validate OTP: %s' % e)
+        return 'ERROR'
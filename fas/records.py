@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+'''
+Lightweight records for the listings built straight from database rows.
+
+The listings send thousands of people, roles and groups.  These classes use
+__slots__ so each one costs a fixed handful of pointers instead of a dict.
+They can be read by attribute or by key like the Bunch objects they
+replace and encode to the same JSON.
+'''
+
+from fas.model import People
+
+class Record(object):
+    '''Base class for records with a fixed list of fields.
+
+    Subclasses set ``fields`` and ``__slots__`` to the same tuple.  Values
+    are given positionally in the order of ``fields``, one for each field.
+    A record made without any values has all of them None.
+    '''
+    __slots__ = ()
+    fields = ()
+
+    def __init__(self, *values):
+        if not values:
+            values = (None,) * len(self.fields)
+        elif len(values) != len(self.fields):
+            raise TypeError('%s takes %d values (%s), %d given' % (
+                self.__class__.__name__, len(self.fields),
+                ', '.join(self.fields), len(values)))
+        for field, value in zip(self.fields, values):
+            setattr(self, field, value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return list(self.fields)
+
+    def __json__(self):
+        return dict((field, getattr(self, field)) for field in self.fields)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            '%s=%r' % (field, getattr(self, field)) for field in self.fields))
+
+class PersonRecord(Record):
+    '''A person in User.list.'''
+    fields = People.allow_fields['complete'] + ('group_roles', 'memberships',
+            'roles')
+    __slots__ = fields
+
+class GroupRecord(Record):
+    '''A group the people in User.list belong to.'''
+    fields = ('id', 'display_name', 'name', 'invite_only', 'url', 'creation',
+            'irc_network', 'needs_sponsor', 'prerequisite_id',
+            'user_can_remove', 'mailing_list_url', 'mailing_list',
+            'irc_channel', 'apply_rules', 'joinmsg', 'group_type',
+            'owner_id')
+    __slots__ = fields
+
+class RoleRecord(Record):
+    '''The role of a person in a group in User.list.'''
+    fields = ('internal_comments', 'role_status', 'creation', 'sponsor_id',
+            'person_id', 'approval', 'group_id', 'role_type')
+    __slots__ = fields
+
+class MemberRecord(Record):
+    '''A membership in the group list.'''
+    fields = ('person_id', 'role_type')
+    __slots__ = fields
+
+class DumpRecord(Record):
+    '''A person in User.dump.'''
+    fields = ('username', 'id', 'ssh_key', 'human_name', 'password')
+    __slots__ = fields
@@ -25,24 +25,29 @@ System.
 '''
 
 import crypt
+import hmac
+import threading
 try:
     from hashlib import sha1 as hash_constructor
 except ImportError:
     from sha import new as hash_constructor
 
+from sqlalchemy import select
 from sqlalchemy.orm import class_mapper
 from turbogears import config, identity, flash
 from turbogears.database import session
 from turbogears.util import load_class
 from turbogears.identity import set_login_attempted
 
-from fas.model import People, Configs
+from fas.model import People, RevokedTokensTable, remember
+from fas.cache import SharedCache, mc
+from fas import lastseen
+from fas.otp import verify_otp
 
 import pytz
 from datetime import datetime
 
-import sys, os, re
-import urllib2
+import sys, os, re, time
 
 import cherrypy
 
@@ -60,20 +65,74 @@ except NameError:
     from sets import Set as set # pylint: disable-msg=W0622
     from sets import ImmutableSet as frozenset # pylint: disable-msg=W0622
 
+# Maps visit keys to what SaFasIdentity knows about the logged in user.
+# Membership and account status changes bump the 'identity' generation.
+identity_cache = SharedCache('identity', 'identity',
+        ttl=int(config.get('identity.cache_ttl', 60)),
+        size=int(config.get('identity.cache_size', 10000)))
+
 # Global class references --
 # these will be set when the provider is initialised.
 user_class = None
 visit_class = None
 
-def get_configs(configs_list):
-    configs = {}
-    for config in configs_list:
-        configs[config.attribute] = config.value
-    if 'enabled' not in configs:
-        configs['enabled'] = '0'
-    if 'prefix' not in configs:
-        configs['prefix'] = 'Not Defined'
-    return configs
+# Passwords that recently matched their crypt hash.  The keys are HMACs of
+# the username, password and hash under a secret that never leaves this
+# process, so neither the passwords nor anything that could be checked
+# against them are kept.  Changing the password changes the hash and with it
+# the key.
+_verified_secret = os.urandom(32)
+_verified = {}
+_verified_lock = threading.Lock()
+
+def _credential_key(user_name, password, hashed):
+    # The database hands back unicode.  Joining that with the utf-8 encoded
+    # password would fail for non-ASCII passwords.
+    parts = []
+    for part in (user_name, password, hashed):
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        parts.append(part)
+    return hmac.new(_verified_secret, '\0'.join(parts),
+            hash_constructor).digest()
+
+def password_matches(user_name, password, hashed):
+    '''Check `password` against the crypt `hashed` password of a user.
+
+    Successful checks are remembered for ``identity.password_cache_ttl``
+    seconds so that clients logging in on every request only pay for crypt
+    once in a while.
+
+    :arg user_name: Username the password belongs to
+    :arg password: Given plaintext password, utf-8 encoded
+    :arg hashed: The crypt hash stored for the user
+    :returns: True if the password matches the hash
+    '''
+    ttl = int(config.get('identity.password_cache_ttl', 300))
+    key = _credential_key(user_name, password, hashed)
+    now = time.time()
+    expires = _verified.get(key)
+    if expires and now < expires:
+        return True
+
+    if hashed != crypt.crypt(password, hashed):
+        return False
+
+    if ttl > 0:
+        _verified_lock.acquire()
+        try:
+            if len(_verified) >= int(config.get(
+                    'identity.password_cache_size', 10000)):
+                for old_key, old_expires in _verified.items():
+                    if old_expires <= now:
+                        del _verified[old_key]
+                if len(_verified) >= int(config.get(
+                        'identity.password_cache_size', 10000)):
+                    _verified.clear()
+            _verified[key] = now + ttl
+        finally:
+            _verified_lock.release()
+    return True
 
 def otp_check(key):
     '''Check otp key string'''
@@ -93,31 +152,149 @@ def otp_validate(user_name, otp):
     :arg otp: Given OTP key
     :returns: True if given args match from OTP provider
     '''
-    client_id = '1'
-
     target = People.by_username(user_name)
-    configs = get_configs(Configs.query.filter_by(person_id=target.id, application='yubikey').all())
+    status = verify_otp(target.id, otp)
+    if status != 'OK':
+        log.debug('OTP refused for %s: %s' % (user_name, status))
+        return False
+    return True
 
-    if not otp.startswith(configs['prefix']):
-      return False
+def _stateless():
+    return config.get('identity.stateless', False)
 
-    server_prefix = config.get('yubi_server_prefix', 'http://localhost/yk-val/verify?id=')
-    auth_regex = re.compile('^status=(?P<rc>\w{2})')
+def _token_lifetime():
+    return int(config.get('identity.token.lifetime',
+        int(config.get('visit.timeout', 20)) * 60))
 
-    server_url = server_prefix + client_id + "&otp=" + otp
+def _same_string(first, second):
+    '''Compare two strings in time that doesn't depend on where they differ.'''
+    if len(first) != len(second):
+        return False
+    result = 0
+    for char1, char2 in zip(first, second):
+        result |= ord(char1) ^ ord(char2)
+    return result == 0
+
+def _revoked_token_key(visit_key):
+    return 'identity-token-revoked:%s' % visit_key
+
+class SignedVisit(object):
+    '''The user a visit is logged in as, read from a signed token.
+
+    With ``identity.stateless`` turned on this takes the place of the
+    VisitIdentity rows.  The token is kept in a cookie and carries the user
+    id, whether the login used an SSL certificate and when it was issued (in
+    milliseconds), signed together with the visit key using
+    ``identity.token.secret``.  Tokens are good for
+    ``identity.token.lifetime`` seconds and are reissued once half of that
+    has passed.
+
+    Logging out records the time in the revoked_tokens table so that the
+    tokens issued to the visit before then are refused.  memcached keeps a
+    copy (0 when the visit was never revoked) so the table is only read
+    when that copy is missing.
+    '''
+    def __init__(self, visit_key, user_id, ssl, issued):
+        self.visit_key = visit_key
+        self.user_id = user_id
+        self.ssl = ssl
+        self.issued = issued
+        self.signature = hmac.new(config.get('identity.token.secret'),
+            '%s:%d:%d:%d' % (visit_key, user_id, ssl, issued),
+            hash_constructor).hexdigest()
+
+    def __str__(self):
+        return '%d:%d:%d:%s' % (self.user_id, self.ssl, self.issued,
+                self.signature)
+
+    def _get_age(self):
+        return time.time() - self.issued / 1000.0
+    age = property(_get_age)
+
+    @classmethod
+    def create(cls, visit_key, user_id, ssl):
+        '''Make a new token for `user_id` logging in to `visit_key`.'''
+        return cls(visit_key, user_id, int(bool(ssl)),
+                int(time.time() * 1000))
+
+    @classmethod
+    def parse(cls, visit_key, token):
+        '''Check a token from a cookie.
+
+        :returns: the SignedVisit or None if the token is malformed, was not
+            signed for this visit, has expired or was revoked
+        '''
+        try:
+            user_id, ssl, issued, signature = token.split(':')
+            visit = cls(visit_key, int(user_id), int(ssl), int(issued))
+        except (ValueError, TypeError):
+            return None
+        if not _same_string(visit.signature, signature):
+            return None
+        if visit.age >= _token_lifetime():
+            return None
+        revoked = mc.get(_revoked_token_key(visit_key))
+        if revoked is None:
+            # Not cached or evicted, the table has the last word
+            revoked = select([RevokedTokensTable.c.revoked],
+                    RevokedTokensTable.c.visit_key == visit_key
+                    ).execute().scalar() or 0
+            mc.set(_revoked_token_key(visit_key), revoked, _token_lifetime())
+        if revoked and visit.issued < revoked:
+            return None
+        return visit
 
-    fh = urllib2.urlopen(server_url)
+    @classmethod
+    def from_cookie(cls, visit_key):
+        '''Check the token the client sent for `visit_key`.
 
-    for line in fh:
-        match = auth_regex.search(line.strip('\n'))
-        if match:
-            if match.group('rc') == 'OK':
-                return True
-        else:
-            return False
-        break
+        The result is kept for the rest of the request so the visit manager
+        and the identity provider only check the token once.
 
-    return False
+        :returns: the SignedVisit or None if there is no valid token
+        '''
+        name = config.get('identity.token.cookie_name', 'fas_identity')
+        try:
+            token = cherrypy.request.simple_cookie[name].value
+        except KeyError:
+            return None
+        checked = getattr(cherrypy.request, 'fas_signed_visit', None)
+        if checked is None or checked[:2] != (visit_key, token):
+            checked = (visit_key, token, cls.parse(visit_key, token))
+            cherrypy.request.fas_signed_visit = checked
+        return checked[2]
+
+    @classmethod
+    def revoke(cls, visit_key):
+        '''Refuse the tokens issued to `visit_key` so far.'''
+        revoked = int(time.time() * 1000)
+        session.execute(RevokedTokensTable.delete(
+            RevokedTokensTable.c.visit_key == visit_key))
+        session.execute(RevokedTokensTable.insert().values(
+            visit_key=visit_key, revoked=revoked))
+        mc.set(_revoked_token_key(visit_key), revoked, _token_lifetime())
+        request = cherrypy.request
+        if getattr(request, 'fas_signed_visit', (None,))[0] == visit_key:
+            del request.fas_signed_visit
+
+    def send(self):
+        '''Set the cookie holding this token on the response.'''
+        name = config.get('identity.token.cookie_name', 'fas_identity')
+        cherrypy.response.simple_cookie[name] = str(self)
+        cookie = cherrypy.response.simple_cookie[name]
+        cookie['path'] = config.get('visit.cookie.path', '/')
+        cookie['max-age'] = _token_lifetime()
+        if config.get('visit.cookie.secure', False):
+            cookie['secure'] = True
+
+    @classmethod
+    def clear(cls):
+        '''Remove the token cookie from the client.'''
+        name = config.get('identity.token.cookie_name', 'fas_identity')
+        cherrypy.response.simple_cookie[name] = ''
+        cookie = cherrypy.response.simple_cookie[name]
+        cookie['path'] = config.get('visit.cookie.path', '/')
+        cookie['max-age'] = 0
 
 class SaFasIdentity(object):
     '''Identity that uses a model from a database (via SQLAlchemy).'''
@@ -143,6 +320,9 @@ class SaFasIdentity(object):
             return None
 
         user = user_class.query.get(visit.user_id)
+        if user:
+            # Controllers usually look the person up again
+            remember(user, 'id', 'username')
 
         # This is a hack, need to talk to Toshio abvout it.w
         user.approved_memberships
@@ -154,31 +334,93 @@ class SaFasIdentity(object):
             user = None
         return user
 
-    def _get_user(self):
-        '''Get user instance for this identity.'''
-        visit = self.visit_link
-        if not visit:
-            self._user = None
-        else:
-            if (not '_csrf_token' in cherrypy.request.params or
-                    cherrypy.request.params['_csrf_token'] !=
-                    hash_constructor(self.visit_key).hexdigest()):
-                log.info("Bad _csrf_token")
-                if '_csrf_token' in cherrypy.request.params:
-                    log.info("visit: %s token: %s" % (self.visit_key,
-                        cherrypy.request.params['_csrf_token']))
-                else:
-                    log.info('No _csrf_token present')
-                cherrypy.request.fas_identity_failure_reason = 'bad_csrf'
+    def _check_csrf(self):
+        '''Check that the request carries the token for this visit.'''
+        if (not '_csrf_token' in cherrypy.request.params or
+                cherrypy.request.params['_csrf_token'] !=
+                hash_constructor(self.visit_key).hexdigest()):
+            log.info("Bad _csrf_token")
+            if '_csrf_token' in cherrypy.request.params:
+                log.info("visit: %s token: %s" % (self.visit_key,
+                    cherrypy.request.params['_csrf_token']))
+            else:
+                log.info('No _csrf_token present')
+            cherrypy.request.fas_identity_failure_reason = 'bad_csrf'
+            return False
+        return True
+
+    def _get_info(self):
+        '''Get what the identity needs to know about the logged in user.
+
+        This is shared between requests through :data:`identity_cache` so
+        that the visit, the user and their groups don't have to be read
+        from the database on every request.
+
+        :returns: dict with the user's id, username, status, the names and
+            ids of their approved groups and whether the visit requires
+            SSL.  None if there is no logged in user.
+        '''
+        try:
+            return self._info
+        except AttributeError:
+            pass
+        self._info = None
+
+        info = None
+        if self.visit_key is not None and not hasattr(self, '_user'):
+            info = identity_cache.get(self.visit_key)
+        if info is None or _stateless():
+            # Signed tokens are cheap to check so they always are
+            visit = self.visit_link
+            if not visit:
                 self._user = None
+                return None
+            if info is not None and info['user_id'] != visit.user_id:
+                info = None
 
+        if not self._check_csrf():
+            self._user = None
+            return None
+
+        if info is not None:
+            if info['ssl'] and \
+                    cherrypy.request.headers['X-Client-Verify'] != 'SUCCESS':
+                self.logout()
+                return None
+        else:
             try:
-                return self._user
+                user = self._user
             except AttributeError:
                 # User hasn't already been set
                 # Attempt to load the user. After this code executes, there
                 # *will* be a _user attribute, even if the value is None.
-                self._user = self.__retrieve_user(visit)
+                user = self._user = self.__retrieve_user(visit)
+            if not user:
+                return None
+            memberships = user.approved_memberships
+            info = dict(user_id=user.id, username=user.username,
+                    status=user.status,
+                    groups=frozenset([g.name for g in memberships]),
+                    group_ids=frozenset([g.id for g in memberships]),
+                    ssl=bool(visit.ssl))
+            identity_cache.set(self.visit_key, info)
+        self._info = info
+        return info
+    info = property(_get_info)
+
+    def _get_user(self):
+        '''Get user instance for this identity.'''
+        info = self.info
+        if not info:
+            self._user = None
+            return None
+        try:
+            return self._user
+        except AttributeError:
+            # Only the cached information was needed so far
+            self._user = user_class.query.get(info['user_id'])
+            if self._user:
+                remember(self._user, 'id', 'username')
         return self._user
     user = property(_get_user)
 
@@ -191,10 +433,10 @@ class SaFasIdentity(object):
 
     def _get_user_name(self):
         '''Get user name of this identity.'''
-        if not self.user:
+        if not self.info:
             return None
         ### TG: Difference: Different name for the field
-        return self.user.username
+        return self.info['username']
     user_name = property(_get_user_name)
 
     ### TG: Same as TG-1.0.8
@@ -208,7 +450,7 @@ class SaFasIdentity(object):
     ### TG: Same as TG-1.0.8
     def _get_anonymous(self):
         '''Return true if not logged in.'''
-        return not self.user
+        return not self.info
     anonymous = property(_get_anonymous)
 
     def _get_only_token(self):
@@ -233,34 +475,20 @@ class SaFasIdentity(object):
 
     def _get_groups(self):
         '''Get set of group names of this identity.'''
-        try:
-            return self._groups
-        except AttributeError:
-            # Groups haven't been computed yet
-            pass
-        if not self.user:
-            self._groups = frozenset()
-        else:
-            ### TG: Difference.  Our model has a many::many for people:groups
-            # And an association proxy that links them together
-            self._groups = frozenset([g.name for g in self.user.approved_memberships])
-        return self._groups
+        if not self.info:
+            return frozenset()
+        ### TG: Difference.  Our model has a many::many for people:groups
+        # The names are collected from approved_memberships by _get_info
+        return self.info['groups']
     groups = property(_get_groups)
 
     def _get_group_ids(self):
         '''Get set of group IDs of this identity.'''
-        try:
-            return self._group_ids
-        except AttributeError:
-            # Groups haven't been computed yet
-            pass
-        if not self.user:
-            self._group_ids = frozenset()
-        else:
-            ### TG: Difference.  Our model has a many::many for people:groups
-            # And an association proxy that links them together
-            self._group_ids = frozenset([g.id for g in self.user.approved_memberships])
-        return self._group_ids
+        if not self.info:
+            return frozenset()
+        ### TG: Difference.  Our model has a many::many for people:groups
+        # The ids are collected from approved_memberships by _get_info
+        return self.info['group_ids']
     group_ids = property(_get_group_ids)
 
     ### TG: Same as TG-1.0.8
@@ -270,6 +498,14 @@ class SaFasIdentity(object):
             return self._visit_link
         if self.visit_key is None:
             self._visit_link = None
+        elif _stateless():
+            visit = SignedVisit.from_cookie(self.visit_key)
+            if visit and visit.age > _token_lifetime() / 2:
+                # Keep active visits logged in like the visit table does
+                visit = SignedVisit.create(self.visit_key, visit.user_id,
+                        visit.ssl)
+                visit.send()
+            self._visit_link = visit
         else:
             self._visit_link =  visit_class.query.filter_by(visit_key=self.visit_key).first()
         return self._visit_link
@@ -284,10 +520,18 @@ class SaFasIdentity(object):
     ### TG: Same as TG-1.0.8
     def login(self, using_ssl=False):
         '''Set the link between this identity and the visit.'''
+        if _stateless():
+            SignedVisit.revoke(self.visit_key)
+            self._visit_link = SignedVisit.create(self.visit_key,
+                    self._user.id, using_ssl)
+            self._visit_link.send()
+            identity_cache.revoke(self.visit_key)
+            return
         visit = self.visit_link
         if visit:
             visit.user_id = self._user.id
             visit.ssl = using_ssl
+            identity_cache.revoke(self.visit_key)
         else:
             visit = visit_class()
             visit.visit_key = self.visit_key
@@ -298,10 +542,17 @@ class SaFasIdentity(object):
     ### TG: Same as TG-1.0.8
     def logout(self):
         '''Remove the link between this identity and the visit.'''
-        visit = self.visit_link
-        if visit:
-            session.delete(visit)
-            session.flush()
+        if _stateless():
+            if self.visit_key is not None:
+                SignedVisit.revoke(self.visit_key)
+            SignedVisit.clear()
+        else:
+            visit = self.visit_link
+            if visit:
+                session.delete(visit)
+                session.flush()
+        if self.visit_key is not None:
+            identity_cache.revoke(self.visit_key)
         # Clear the current identity
         identity.set_current_identity(SaFasIdentity())
 
@@ -322,6 +573,10 @@ class SaFasIdentityProvider(object):
                 {'visitmod': visit_class_path})
         visit_class = load_class(visit_class_path)
 
+        if _stateless() and not config.get('identity.token.secret'):
+            raise identity.IdentityConfigurationException(
+                    'identity.stateless needs identity.token.secret to be set')
+
     def create_provider_model(self):
         '''
         Create the database tables if they don't already exist.
@@ -411,7 +666,7 @@ class SaFasIdentityProvider(object):
 
         log.info("Associating user (%s) with visit (%s)",
             user_name, visit_key)
-        user.last_seen = datetime.now(pytz.utc)
+        lastseen.seen(user.id, datetime.now(pytz.utc))
         return SaFasIdentity(visit_key, user, using_ssl)
 
     def validate_password(self, user, user_name, password, otp=None):
@@ -438,7 +693,8 @@ class SaFasIdentityProvider(object):
             return False
 
         # Check if given password matches existing one
-        check_pw = (user.password == crypt.crypt(password.encode('utf-8'), user.password))
+        check_pw = password_matches(user.username, password.encode('utf-8'),
+                user.password)
 
         # Check if combo login (password+otp) has been requested.
         if otp:
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+'''
+Count the SQL statements each request runs.
+
+:class:`QueryStats` is installed as the proxy of the engine in
+:mod:`fas.model` and notes the number of statements, the time spent in the
+database and how often each statement shape (the SQL with its values and
+the length of IN lists taken out) ran during the current request.
+
+At the end of every request :class:`SqlStatsFilter`
+
+* adds them to a report per controller method (see :data:`report` and
+  json/sql_report),
+* warns in the log when one statement shape ran more than
+  ``sql_stats.repeat_warning`` times, usually a relation loaded lazily in a
+  loop, and
+* sends them in an X-FAS-SQL response header when ``sql_stats.header`` is
+  on (it defaults to the ``debug`` setting).
+'''
+
+import re
+import threading
+import time
+
+import cherrypy
+from sqlalchemy.interfaces import ConnectionProxy
+from turbogears import config
+
+import logging
+log = logging.getLogger('fas.sqlstats')
+
+# [requests, statements, seconds, most statements in one request] for each
+# controller method, in this process
+report = {}
+report_lock = threading.Lock()
+
+_literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|%s"
+        r"|:\w+|\?")
+_in_list_re = re.compile(r'\bIN\s*\((?:\s*\?\s*,?)+\)', re.IGNORECASE)
+_space_re = re.compile(r'\s+')
+
+def fingerprint(statement):
+    '''Reduce a statement to its shape.
+
+    Values, bind parameters and the length of IN lists are replaced so that
+    the statements a loop runs for each of its items look the same.
+    '''
+    shape = _literal_re.sub('?', statement)
+    shape = _in_list_re.sub('IN (...)', shape)
+    return _space_re.sub(' ', shape).strip()
+
+def request_stats():
+    '''Return the statistics of the current request.
+
+    :returns: dict with the ``count`` of statements, the ``time`` they
+        took and the number of times each statement ``shape`` ran, or None
+        outside of a request.
+    '''
+    try:
+        request = cherrypy.request
+        stats = getattr(request, 'fas_sql', None)
+        if stats is None:
+            stats = request.fas_sql = dict(count=0, time=0.0, shapes={})
+    except AttributeError:
+        return None
+    return stats
+
+class QueryStats(ConnectionProxy):
+    '''Engine proxy recording the statements run for each request.'''
+    def cursor_execute(self, execute, cursor, statement, parameters,
+            context, executemany):
+        start = time.time()
+        try:
+            return execute(cursor, statement, parameters, context)
+        finally:
+            stats = request_stats()
+            if stats is not None:
+                stats['count'] += 1
+                stats['time'] += time.time() - start
+                shape = fingerprint(statement)
+                stats['shapes'][shape] = stats['shapes'].get(shape, 0) + 1
+
+def handler_name():
+    '''Return the name of the controller method handling the request.
+
+    :returns: dotted path of the method from the root controller, for
+        instance ``user.view``.  Arguments in the URL are left out.
+    '''
+    request = cherrypy.request
+    path = getattr(request, 'object_path', None) or request.path
+    webpath = config.get('server.webpath', '').rstrip('/')
+    if webpath and path.startswith(webpath):
+        path = path[len(webpath):]
+    node = cherrypy.root
+    names = []
+    for part in path.strip('/').split('/'):
+        child = getattr(node, part.replace('.', '_'), None)
+        if child is None or not getattr(child, 'exposed', True):
+            break
+        names.append(part)
+        node = child
+        if getattr(node, 'exposed', False):
+            # Reached the method, the rest are its arguments
+            break
+    return '.'.join(names) or 'index'
+
+class SqlStatsFilter(object):
+    '''CherryPy filter reporting the statistics of each request.'''
+    def before_finalize(self):
+        stats = getattr(cherrypy.request, 'fas_sql', None)
+        if not stats:
+            return
+        name = handler_name()
+
+        report_lock.acquire()
+        try:
+            entry = report.setdefault(name, [0, 0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += stats['count']
+            entry[2] += stats['time']
+            entry[3] = max(entry[3], stats['count'])
+        finally:
+            report_lock.release()
+
+        limit = int(config.get('sql_stats.repeat_warning', 10))
+        for shape, count in stats['shapes'].iteritems():
+            if count > limit:
+                log.warning('%s ran the same statement %d times: %s' %
+                        (name, count, shape))
+
+        if config.get('sql_stats.header', config.get('debug', False)):
+            cherrypy.response.headers['X-FAS-SQL'] = \
+                'queries=%d; time=%.1fms; shapes=%d' % (stats['count'],
+                        stats['time'] * 1000, len(stats['shapes']))
+
+def sql_report():
+    '''Return the per controller method report as a list of dicts.'''
+    report_lock.acquire()
+    try:
+        entries = report.items()
+    finally:
+        report_lock.release()
+    entries.sort(key=lambda item: item[1][2], reverse=True)
+    return [dict(method=name, requests=requests, queries=queries,
+        seconds=seconds, queries_per_request=float(queries) / requests,
+        max_queries=max_queries)
+        for name, (requests, queries, seconds, max_queries) in entries]
@@ -0,0 +1,165 @@
+'''Check that the fas.auth predicates answered from role maps give the same
+answers the per-check queries used to give.'''
+
+import unittest
+
+from turbogears import config
+
+from fas import auth
+
+class FakeGroup(object):
+    def __init__(self, id, name, owner=None, group_type='tracking'):
+        self.id = id
+        self.name = name
+        self.owner = owner
+        self.group_type = group_type
+
+class FakePerson(object):
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+        self.group_roles = {}
+
+class FakeRole(object):
+    def __init__(self, person, group, role_type, role_status):
+        self.member = person
+        self.group = group
+        self.group_id = group.id
+        self.role_type = role_type
+        self.role_status = role_status
+        person.group_roles[group.name] = self
+
+class FakeQuery(object):
+    '''Just enough of PersonRoles.query for fas.auth.role_map.'''
+    def __init__(self, roles, counter):
+        self.roles = roles
+        self.counter = counter
+
+    def join(self, relation):
+        return self
+
+    def filter_by(self, username=None, member=None):
+        if username is not None:
+            roles = [r for r in self.roles if r.member.username == username]
+        else:
+            roles = [r for r in self.roles if r.member is member]
+        return FakeQuery(roles, self.counter)
+
+    def all(self):
+        self.counter.append(1)
+        return list(self.roles)
+
+class FakePersonRoles(object):
+    pass
+
+# (role_type, role_status) in the tested group for each kind of person.
+# None means they are not a member.
+PEOPLE = {
+    'owner': None,
+    'admin': ('administrator', 'approved'),
+    'unapproved_admin': ('administrator', 'unapproved'),
+    'sponsor': ('sponsor', 'approved'),
+    'unapproved_sponsor': ('sponsor', 'unapproved'),
+    'user': ('user', 'approved'),
+    'unapproved_user': ('user', 'unapproved'),
+    'outsider': None,
+    'fas_admin': None,
+}
+
+def expected(name, as_string):
+    '''What the per-check queries answered for each predicate.'''
+    role = PEOPLE[name]
+    approved = role is not None and role[1] == 'approved'
+    fas_admin = name == 'fas_admin'
+    owner = name == 'owner'
+    admin_role = approved and role[0] == 'administrator'
+    sponsor_role = approved and role[0] == 'sponsor'
+    return {
+        # For People objects can_admin_group compares the owner's username
+        # to the object so ownership alone never counted.
+        'can_admin_group': fas_admin or (owner and as_string) or admin_role,
+        'can_sponsor_group': fas_admin or owner or admin_role or sponsor_role,
+        'is_approved': approved,
+        'is_admin': fas_admin,
+    }
+
+class TestRoleMapChecks(unittest.TestCase):
+    def setUp(self):
+        config.update({'admingroup': 'accounts',
+            'cla_done_group': 'cla_done'})
+        self.queries = []
+        self.people = {}
+        self.roles = []
+        accounts = FakeGroup(1, 'accounts')
+        cla = FakeGroup(2, 'cla_done', group_type='cla')
+        for person_id, name in enumerate(sorted(PEOPLE)):
+            self.people[name] = FakePerson(person_id + 10, name)
+        self.group = FakeGroup(3, 'packager', owner=self.people['owner'])
+        for name, role in PEOPLE.items():
+            person = self.people[name]
+            if role:
+                self.roles.append(FakeRole(person, self.group, *role))
+            if name != 'outsider':
+                self.roles.append(FakeRole(person, cla, 'user', 'approved'))
+        self.roles.append(FakeRole(self.people['fas_admin'], accounts, 'user',
+            'approved'))
+
+        FakePersonRoles.query = FakeQuery(self.roles, self.queries)
+        self.saved = (auth.PersonRoles, auth.request_role_maps)
+        auth.PersonRoles = FakePersonRoles
+        self.maps = None
+        auth.request_role_maps = lambda: self.maps
+
+    def tearDown(self):
+        auth.PersonRoles, auth.request_role_maps = self.saved
+
+    def check(self, as_string):
+        for name in PEOPLE:
+            person = self.people[name]
+            if as_string:
+                person = person.username
+            wanted = expected(name, as_string)
+            self.assertEqual(auth.can_admin_group(person, self.group),
+                    wanted['can_admin_group'], (name, 'can_admin_group'))
+            self.assertEqual(auth.can_sponsor_group(person, self.group),
+                    wanted['can_sponsor_group'], (name, 'can_sponsor_group'))
+            self.assertEqual(auth.is_approved(person, self.group),
+                    wanted['is_approved'], (name, 'is_approved'))
+            if as_string:
+                # Objects take this from identity or group_roles
+                self.assertEqual(auth.is_admin(person), wanted['is_admin'],
+                        (name, 'is_admin'))
+                self.assertEqual(auth.check_membership(person,
+                    'admingroup'), wanted['is_admin'], name)
+            if name != 'outsider':
+                self.assertTrue(auth.cla_done(person), name)
+
+    def test_usernames(self):
+        self.check(True)
+
+    def test_people(self):
+        self.check(False)
+
+    def test_outsider_cla(self):
+        self.assertFalse(auth.cla_done(self.people['outsider']))
+
+    def test_one_query_per_person(self):
+        self.maps = {}
+        self.check(True)
+        self.check(False)
+        # At most once for the username and once for the object of each
+        # person, and never again afterwards
+        self.assertTrue(len(self.queries) <= len(PEOPLE) * 2)
+        count = len(self.queries)
+        self.check(True)
+        self.check(False)
+        self.assertEqual(len(self.queries), count)
+
+    def test_undeprecated_cla_done(self):
+        config.update({'cla_deprecated_groups': []})
+        self.assertEqual(auth.undeprecated_cla_done('user'), (True, False))
+        self.assertEqual(auth.undeprecated_cla_done('outsider'),
+                (False, False))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+'''Check that CachedValue copes with values larger than a memcached item.'''
+
+import os
+import time
+import unittest
+
+from fas import cache
+
+class FakeMemcache(object):
+    '''Just enough of memcache.Client, refusing items over 1MB like memcached.'''
+    limit = 1024 * 1024
+
+    def __init__(self):
+        self.items = {}
+        self.sets = 0
+
+    def get(self, key):
+        return self.items.get(key)
+
+    def get_multi(self, keys):
+        return dict((key, self.items[key]) for key in keys
+                if key in self.items)
+
+    def set(self, key, value, time=0, min_compress_len=0):
+        self.sets += 1
+        if isinstance(value, str) and len(value) > self.limit:
+            return False
+        if isinstance(value, dict) and 'value' in value \
+                and len(repr(value['value'])) > self.limit:
+            return False
+        self.items[key] = value
+        return True
+
+    def set_multi(self, mapping, time=0):
+        return [key for key, value in mapping.items()
+                if not self.set(key, value, time)]
+
+    def add(self, key, value, time=0):
+        if key in self.items:
+            return False
+        self.items[key] = value
+        return True
+
+    def delete(self, key):
+        self.items.pop(key, None)
+
+def big_value():
+    # Random data does not compress, like password hashes and ssh keys
+    return dict((str(number), os.urandom(100).encode('hex'))
+            for number in range(20000))
+
+class TestCachedValue(unittest.TestCase):
+    def setUp(self):
+        self.saved = cache.mc
+        cache.mc = FakeMemcache()
+        self.builds = []
+
+    def tearDown(self):
+        cache.mc = self.saved
+
+    def builder(self, value):
+        def build():
+            self.builds.append(1)
+            return value
+        return build
+
+    def test_large_value(self):
+        value = big_value()
+        cached = cache.CachedValue('test', 'test')
+        self.assertEqual(cached.get(self.builder(value)), value)
+        self.assertEqual(cached.get(self.builder(value)), value)
+        self.assertEqual(len(self.builds), 1)
+
+    def test_evicted_chunk(self):
+        value = big_value()
+        cached = cache.CachedValue('test', 'test')
+        cached.get(self.builder(value))
+        chunk = [key for key in cache.mc.items if key.endswith(':0')][0]
+        cache.mc.delete(chunk)
+        self.assertEqual(cached.get(self.builder(value)), value)
+        self.assertEqual(len(self.builds), 2)
+
+    def test_uncacheable(self):
+        value = big_value()
+        cached = cache.CachedValue('test', 'test')
+        cached.chunk_size = 2 * FakeMemcache.limit
+        self.assertEqual(cached.get(self.builder(value)), value)
+        sets = cache.mc.sets
+        # Built again without trying to store it
+        self.assertEqual(cached.get(self.builder(value)), value)
+        self.assertEqual(len(self.builds), 2)
+        self.assertEqual(cache.mc.sets, sets)
+
+    def test_holder_failed(self):
+        # Another worker holds the lock and gives up on storing the value
+        # after the first look
+        cache.mc.items['test:lock'] = 1
+        get = cache.mc.get
+        def get_once(key):
+            value = get(key)
+            if key == 'test:lock':
+                cache.mc.delete(key)
+            return value
+        cache.mc.get = get_once
+        cached = cache.CachedValue('test', 'test')
+        start = time.time()
+        self.assertEqual(cached.get(self.builder('value')), 'value')
+        self.assertTrue(time.time() - start < 1)
+
+if __name__ == '__main__':
+    unittest.main()
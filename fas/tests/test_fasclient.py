@@ -0,0 +1,123 @@
+'''Check how fasClient merges incremental downloads into its saved data.'''
+
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+CLIENT = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))), 'client', 'fasClient')
+
+def group(gid, users=()):
+    return {'id': gid, 'type': 'tracking', 'administrators': [],
+            'sponsors': [], 'users': list(users)}
+
+def load_client(workdir):
+    '''Import fasClient with a config keeping everything in `workdir`.'''
+    config_file = os.path.join(workdir, 'fas.conf')
+    conf = open(config_file, 'w')
+    conf.write('[global]\nurl = http://localhost/accounts/\n'
+            'temp = %s\nprefix = %s\ncla_group = cla_done\n'
+            'sync_state = %s\n' % (workdir, workdir,
+                os.path.join(workdir, 'sync_state')))
+    conf.close()
+    saved_argv = sys.argv
+    sys.argv = ['fasClient', '-c', config_file]
+    try:
+        return imp.load_source('fasClient', CLIENT)
+    finally:
+        sys.argv = saved_argv
+
+class TestIncrementalSync(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.client = load_client(self.workdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def sync(self, response):
+        '''Run one sync of group_data with `response` from the server.'''
+        fas = self.client.MakeShellAccounts.__new__(
+                self.client.MakeShellAccounts)
+        fas.force_refresh = False
+        fas.send_request = lambda *args, **kwargs: response
+        groups = fas._fetch_fas_client('group_data')
+        fas.save_sync_state()
+        return groups
+
+    def test_renamed_group(self):
+        self.sync({'success': True, 'full': True, 'token': 1,
+            'data': {'packager': group(100, ['1']), 'qa': group(101)}})
+        groups = self.sync({'success': True, 'full': False, 'token': 2,
+            'removed': [], 'data': {'packagers': group(100, ['1', '2'])}})
+        self.assertEqual(sorted(groups), ['packagers', 'qa'])
+        self.assertEqual(groups['packagers']['users'], ['1', '2'])
+
+    def test_removed_group(self):
+        self.sync({'success': True, 'full': True, 'token': 1,
+            'data': {'packager': group(100), 'qa': group(101)}})
+        groups = self.sync({'success': True, 'full': False, 'token': 2,
+            'removed': [101], 'data': {}})
+        self.assertEqual(sorted(groups), ['packager'])
+
+# Keys and the hashes glibc's __hash_string (intl/hash-string.c, which makedb
+# and nss_db use) gives them.  The last one carries into bit 32.
+GLIBC_HASHES = {
+    'root': 497252,
+    '1000': 213808,
+    'rz4db6q3ar': 173724706,
+    'l9l9eunuo5vku0m': 221364797,
+    '.l9l9eunuo5vku0m': 47005101,
+}
+
+class TestNssDb(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.client = load_client(self.workdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_hash_string(self):
+        for key, hval in GLIBC_HASHES.items():
+            self.assertEqual(self.client._hash_string(key), hval, key)
+
+class TestSshKeys(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.client = load_client(self.workdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_failed_user(self):
+        # Without child processes an error other than IOError skips the
+        # user like a failed child does instead of ending the run
+        fas = self.client.MakeShellAccounts.__new__(
+                self.client.MakeShellAccounts)
+        fas.full_verify = False
+        fas._install_state = {}
+        fas._users = {'1000': {'username': 'one', 'ssh_key': 'ssh-rsa A'},
+                '1001': {'username': 'two', 'ssh_key': 'ssh-rsa B'}}
+        fas.drop_privs = fas.restore_privs = lambda *args: None
+        written = []
+        def create_ssh_key_user(uid, key):
+            if uid == '1000':
+                raise OSError(13, 'Permission denied')
+            written.append(uid)
+        fas.create_ssh_key_user = create_ssh_key_user
+        user = {'ssh_cmd': None, 'ssh_options': None}
+        saved_getpwuid = self.client.pwd.getpwuid
+        self.client.pwd.getpwuid = lambda uid: None
+        try:
+            fas.create_ssh_keys({'1000': user, '1001': user})
+        finally:
+            self.client.pwd.getpwuid = saved_getpwuid
+        self.assertEqual(written, ['1001'])
+        self.assertEqual(list(fas._install_state['ssh_keys']), ['1001'])
+
+if __name__ == '__main__':
+    unittest.main()
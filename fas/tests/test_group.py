@@ -0,0 +1,22 @@
+'''Check the streamed json group listing.'''
+
+import unittest
+
+from fas.group import stream_group_list
+
+class FakeGroup(object):
+    id = 100002
+
+class TestStreamGroupList(unittest.TestCase):
+    def test_keys(self):
+        # Always the keys of the response turbogears builds itself
+        keys = ['groups', 'search', 'memberships', 'tg_flash']
+        found = dict(stream_group_list([FakeGroup()], '*'))
+        self.assertEqual(sorted(found), sorted(keys))
+        self.assertEqual(found['tg_flash'], None)
+        found = dict(stream_group_list([], 'nothing*'))
+        self.assertEqual(sorted(found), sorted(keys))
+        self.assertTrue(found['tg_flash'])
+
+if __name__ == '__main__':
+    unittest.main()
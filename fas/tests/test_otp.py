@@ -0,0 +1,44 @@
+'''Check the OTP validation client against the stand-in yk-val server.'''
+
+import time
+import unittest
+
+from fas.otp import OtpClient, OtpError
+from fas.tests.ykval import YkvalServer
+
+OTP = 'cccccccbcjdifctrndncchkftchjlnbhvhtugdljibej'
+
+class TestOtpClient(unittest.TestCase):
+    def setUp(self):
+        self.server = YkvalServer()
+        self.server.start()
+        self.client = OtpClient(self.server.url, timeout=1)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_status(self):
+        self.assertEqual(self.client.status(OTP), 'OK')
+        self.assertEqual(self.client.status(OTP), 'REPLAYED_OTP')
+        self.server.bad.add(OTP + 'x')
+        self.assertEqual(self.client.status(OTP + 'x'), 'BAD_OTP')
+
+    def test_connection_reused(self):
+        for number in range(10):
+            self.assertEqual(self.client.status(OTP + str(number)), 'OK')
+        self.assertEqual(self.server.requests, 10)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_timeout(self):
+        self.server.delay = 2
+        start = time.time()
+        self.assertRaises(OtpError, self.client.status, OTP)
+        self.assertTrue(time.time() - start < 2)
+
+    def test_server_down(self):
+        self.server.stop()
+        self.assertRaises(OtpError, self.client.status, OTP)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+'''Check the cached password checks of the identity provider.'''
+
+import crypt
+import unittest
+
+from fas import safasprovider
+
+class TestPasswordMatches(unittest.TestCase):
+    def setUp(self):
+        safasprovider._verified.clear()
+        self.password = u'pässwörd'.encode('utf-8')
+        # Hashes come back from the database as unicode
+        self.hashed = unicode(crypt.crypt(self.password, '$6$saltsalt$'))
+
+    def test_non_ascii_password(self):
+        self.assertTrue(safasprovider.password_matches(u'jörg',
+            self.password, self.hashed))
+        # Answered from the cache the second time
+        self.assertEqual(len(safasprovider._verified), 1)
+        self.assertTrue(safasprovider.password_matches(u'jörg',
+            self.password, self.hashed))
+
+    def test_wrong_password(self):
+        self.assertFalse(safasprovider.password_matches(u'jörg',
+            u'passwörd'.encode('utf-8'), self.hashed))
+        self.assertEqual(len(safasprovider._verified), 0)
+
+if __name__ == '__main__':
+    unittest.main()
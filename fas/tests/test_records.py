@@ -0,0 +1,23 @@
+'''Check building the records of the listings.'''
+
+import unittest
+
+from fas.records import MemberRecord
+
+class TestRecord(unittest.TestCase):
+    def test_values(self):
+        member = MemberRecord(100001, 'user')
+        self.assertEqual(member.person_id, 100001)
+        self.assertEqual(member['role_type'], 'user')
+
+    def test_empty(self):
+        member = MemberRecord()
+        self.assertEqual(member.person_id, None)
+        self.assertEqual(member.role_type, None)
+
+    def test_wrong_count(self):
+        self.assertRaises(TypeError, MemberRecord, 100001)
+        self.assertRaises(TypeError, MemberRecord, 100001, 'user', 'extra')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+'''Check that revoked identity tokens stay revoked without memcached.'''
+
+import unittest
+
+from turbogears import config
+
+from fas import safasprovider
+from fas.safasprovider import SignedVisit
+
+VISIT_KEY = 'a' * 40
+
+class FakeMemcache(object):
+    def __init__(self):
+        self.items = {}
+
+    def get(self, key):
+        return self.items.get(key)
+
+    def set(self, key, value, time=0):
+        self.items[key] = value
+        return True
+
+class FakeSelect(object):
+    '''Stands in for the revoked_tokens lookup.'''
+    def __init__(self, revoked):
+        self.revoked = revoked
+        self.queries = 0
+
+    def __call__(self, *args, **kwargs):
+        self.queries += 1
+        return self
+
+    def execute(self):
+        return self
+
+    def scalar(self):
+        return self.revoked
+
+class TestRevokedTokens(unittest.TestCase):
+    def setUp(self):
+        config.update({'identity.token.secret': 'secret'})
+        self.saved = safasprovider.mc, safasprovider.select
+        safasprovider.mc = FakeMemcache()
+        self.visit = SignedVisit.create(VISIT_KEY, 100001, False)
+        self.token = str(self.visit)
+
+    def tearDown(self):
+        safasprovider.mc, safasprovider.select = self.saved
+
+    def test_not_revoked(self):
+        safasprovider.select = FakeSelect(None)
+        self.assertTrue(SignedVisit.parse(VISIT_KEY, self.token))
+        self.assertTrue(SignedVisit.parse(VISIT_KEY, self.token))
+        # The table is only read until memcached remembers the answer
+        self.assertEqual(safasprovider.select.queries, 1)
+
+    def test_revoked_after_eviction(self):
+        # memcached lost the revocation, the table still has it
+        safasprovider.select = FakeSelect(self.visit.issued + 1)
+        self.assertEqual(SignedVisit.parse(VISIT_KEY, self.token), None)
+        self.assertEqual(SignedVisit.parse(VISIT_KEY, self.token), None)
+        self.assertEqual(safasprovider.select.queries, 1)
+
+    def test_forged(self):
+        safasprovider.select = FakeSelect(None)
+        self.assertEqual(SignedVisit.parse(VISIT_KEY, self.token[:-1] + 'x'),
+                None)
+        self.assertEqual(SignedVisit.parse('b' * 40, self.token), None)
+
+if __name__ == '__main__':
+    unittest.main()
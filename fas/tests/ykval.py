@@ -0,0 +1,83 @@
+'''A stand-in for the yk-val server to test and benchmark OTP validation.
+
+It answers ``status=OK`` for OTPs it hasn't seen before and
+``status=REPLAYED_OTP`` for the ones it has.  OTPs listed in ``bad`` get
+``status=BAD_OTP``.  Connections are kept alive like with the real server.
+'''
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+import urlparse
+
+class YkvalHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one piece like real servers do
+    wbufsize = -1
+
+    def do_GET(self):
+        server = self.server
+        params = urlparse.parse_qs(urlparse.urlsplit(self.path)[3])
+        otp = params.get('otp', [''])[0]
+        if server.delay:
+            time.sleep(server.delay)
+        server.lock.acquire()
+        try:
+            server.requests += 1
+            if otp in server.bad:
+                status = 'BAD_OTP'
+            elif otp in server.seen:
+                status = 'REPLAYED_OTP'
+            else:
+                server.seen.add(otp)
+                status = 'OK'
+        finally:
+            server.lock.release()
+        body = 'h=\r\nt=%s\r\notp=%s\r\nstatus=%s\r\n' % (
+                time.strftime('%Y-%m-%dT%H:%M:%S'), otp, status)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class YkvalServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, delay=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                YkvalHandler)
+        self.delay = delay
+        self.bad = set()
+        self.seen = set()
+        self.requests = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.running = False
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        SocketServer.ThreadingMixIn.process_request(self, request,
+                client_address)
+
+    def _get_url(self):
+        return 'http://127.0.0.1:%d/yk-val/verify?id=' % self.server_address[1]
+    url = property(_get_url)
+
+    def start(self):
+        '''Serve requests from a background thread.'''
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.running = True
+
+    def stop(self):
+        if self.running:
+            self.shutdown()
+            self.running = False
+        self.server_close()
@@ -26,11 +26,6 @@
 # @error_handler() takes a reference to the error() method defined in the
 # class (E0602)
 
-try:
-    from bunch import Bunch
-except ImportError:
-    from fedora.client import DictContainer as Bunch
-
 import turbogears
 from turbogears import controllers, expose, identity, \
         validate, validators, error_handler, config, redirect
@@ -62,7 +57,7 @@ import time
 
 from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError, InvalidRequestError
-from sqlalchemy.sql import select
+from sqlalchemy.sql import select, and_, or_
 
 from fedora.tg.utils import request_format
 
@@ -71,7 +66,10 @@ import fas.fedmsgshim
 import fas
 from fas.model import PeopleTable, PersonRolesTable, GroupsTable
 from fas.model import People, PersonRoles, Groups, Log
-from fas import openssl_fas
+from fas import openssl_fas, lastseen
+from fas.cache import invalidate, CachedValue
+from fas.records import PersonRecord, GroupRecord, RoleRecord, DumpRecord
+from fas.jsonstream import stream_json, JsonArray, SpooledArray
 from fas.auth import (
 	is_admin,
 	cla_done,
@@ -211,6 +209,202 @@ def random_string(charset, length):
 
     return s
 
+def parse_last_seen(last_seen):
+    '''Turn a last_seen request parameter into a datetime.
+
+    :arg last_seen: string in the format YYYY,MM,DD,hh,mm,ss (UTC) or None
+        for now
+    :returns: timezone aware datetime
+    '''
+    if not last_seen:
+        return datetime.now(pytz.utc)
+    update_time = last_seen.split(',')
+    return datetime(int(update_time[0]),   # Year
+                    int(update_time[1]),    # Month
+                    int(update_time[2]),    # Day
+                    int(update_time[3]),    # Hour
+                    int(update_time[4]),    # Minute
+                    int(update_time[5]),    # Second
+                    0,                      # ms
+                    pytz.utc)               # tz
+
+# Attributes of the people built by list_people()
+LIST_FIELDS = frozenset(PersonRecord.fields)
+
+list_groups_cache = CachedValue('list_groups', 'groups')
+
+def build_list_groups(group_ids=None):
+    '''Read the columns of groups that User.list sends.
+
+    :kwarg group_ids: If given, only read these groups
+    :returns: dict mapping group id to a tuple of the GroupRecord fields
+    '''
+    query = select([GroupsTable.c[field] for field in GroupRecord.fields])
+    if group_ids is not None:
+        query = query.where(GroupsTable.c.id.in_(list(group_ids)))
+    return dict((row[0], tuple(row)) for row in query.execute())
+
+def list_people(people, user, requester, thirdparty):
+    '''Build the people for User.list.
+
+    The roles of all the people are read with one query.  Groups come from
+    a cached copy of the groups table that is shared by every request.
+
+    :arg people: Rows of the people table
+    :arg user: Access level of the requester: 'admin', 'public' or
+        'anonymous'
+    :arg requester: Username of the requester
+    :arg thirdparty: Whether the requester is in the thirdparty group
+    :returns: list of (username, person) pairs in the order of `people`
+    '''
+    people = list(people)
+    if not people:
+        return []
+
+    person_roles = dict()
+    roles = select([PersonRolesTable.c[field] for field in RoleRecord.fields],
+            PersonRolesTable.c.person_id.in_([p.id for p in people]))
+    for row in roles.execute():
+        person_roles.setdefault(row.person_id, []).append(RoleRecord(*row))
+
+    group_rows = list_groups_cache.get(build_list_groups)
+    missing = set()
+    for rows in person_roles.itervalues():
+        missing.update(row.group_id for row in rows
+                if row.group_id not in group_rows)
+    if missing:
+        # Created since the cached copy was made
+        group_rows = dict(group_rows)
+        group_rows.update(build_list_groups(missing))
+
+    group_map = dict()
+    results = []
+    # user_perms is a synonym for user with one difference
+    # If user is public then we end up changing user_perms
+    # depending on whether the record is for the user themselves and if
+    # the record has privacy set
+    user_perms = user
+    for record in people:
+        # Create a new person
+        person = PersonRecord()
+        if user == 'public':
+            # The general public gets different fields depending on
+            # the record being accessed
+            if requester == record.username:
+                user_perms = 'self'
+            elif record.privacy:
+                user_perms = 'privacy'
+            else:
+                user_perms = 'public'
+
+        # Every field starts out as None so the client side doesn't get
+        # KeyError.  Fill in the ones the requester may see.
+        for field in People.allow_fields[user_perms]:
+            setattr(person, field, record[field])
+        if thirdparty:
+            # Thirdparty is a little strange as it has to obey the
+            # privacy flag just like a normal user but we allow a few
+            # fields to be sent on in addition (ssh_key for now)
+            for field in People.allow_fields['thirdparty']:
+                setattr(person, field, record[field])
+        # Make sure the password field is a default value that won't
+        # cause issue for scripts
+        if 'password' not in People.allow_fields[user_perms]:
+            person.password = '*'
+
+        person.group_roles = {}
+        person.memberships = []
+        person.roles = []
+
+        # A person without any roles gets one empty role and group, the way
+        # an outer join of people to their roles and groups would give them.
+        for role in person_roles.get(record.id) or [RoleRecord()]:
+            group_id = role.group_id
+            if group_id not in group_map:
+                # Create the group
+                group = GroupRecord(*group_rows.get(group_id, ()))
+                group_map[group_id] = group
+            else:
+                group = group_map[group_id]
+
+            if group.name not in person.group_roles:
+                # Add the group to the person record
+                person.memberships.append(group)
+
+                person.group_roles[group.name] = role
+                person.roles.append(role)
+        results.append((record.username, person))
+    return results
+
+def list_batches(re_search):
+    '''Select the matching people in batches for User.list.
+
+    Only ``json.batch_size`` people are read from the database at a time so
+    the whole directory never has to be held in memory.
+
+    :arg re_search: SQL ILIKE pattern for the usernames
+    :returns: iterator of lists of people rows ordered by username
+    '''
+    batch_size = int(config.get('json.batch_size', 1000))
+    last = None
+    while True:
+        page = select([PeopleTable], People.username.ilike(re_search))\
+                .order_by(PeopleTable.c.username).limit(batch_size)
+        if last is not None:
+            page = page.where(PeopleTable.c.username > last)
+        page = page.execute().fetchall()
+        if not page:
+            break
+        yield page
+        if len(page) < batch_size:
+            break
+        last = page[-1].username
+
+def stream_people_list(re_search, search, fields, user, requester,
+        thirdparty):
+    '''Produce the json response of :meth:`User.list` as it is read.
+
+    People who have not completed the cla are written to a temporary file
+    while the others are sent and are sent afterwards.
+
+    :arg re_search: SQL ILIKE pattern for the usernames
+    :arg search: The search string the pattern was made from
+    :arg fields: Fields to return.  All of them if empty.
+    :arg user: Access level of the requester, see :func:`list_people`
+    :arg requester: Username of the requester
+    :arg thirdparty: Whether the requester is in the thirdparty group
+    :returns: iterator of (key, value) pairs for :func:`stream_json`
+    '''
+    cla_done_group = config.get('cla_done_group', 'cla_done')
+    unapproved = SpooledArray()
+    found = [0]
+
+    def approved():
+        for page in list_batches(re_search):
+            for username, person in list_people(page, user, requester,
+                    thirdparty):
+                found[0] += 1
+                if cla_done_group in person.group_roles:
+                    cla_status = person.group_roles[cla_done_group].role_status
+                else:
+                    cla_status = 'unapproved'
+                if fields:
+                    person = dict((field, getattr(person, field)) for field
+                            in fields)
+                if cla_status == 'approved':
+                    yield person
+                else:
+                    unapproved.append(person)
+
+    yield 'people', JsonArray(approved())
+    yield 'unapproved_people', unapproved
+    yield 'search', search
+    # Same keys as the response turbogears builds when not streaming
+    if found[0]:
+        yield 'tg_flash', None
+    else:
+        yield 'tg_flash', _("No users found matching '%s'") % search
+
 class User(controllers.Controller):
     ''' Our base User controller for user based operations '''
     # Regex to tell if something looks like a crypted password
@@ -478,6 +672,10 @@ If the above information is incorrect, please log in and fix it:
             send_mail(target.email, change_subject, change_text)
             turbogears.flash(_('Your account details have been saved.') + \
                 '  ' + emailflash)
+            if changed:
+                invalidate('user_data')
+            if 'status' in changed:
+                invalidate('identity')
 
             fas.fedmsgshim.send_message(topic="user.update", msg={
                 'agent': person.username,
@@ -523,6 +721,8 @@ If the above information is incorrect, please log in and fix it:
                     target.remove(group, target.username)
                 except fas.RemoveError:
                     pass
+        invalidate('user_data')
+        invalidate('identity')
 
         subject = _('Your Fedora Account has been set to %s') % status
         text = _('''
@@ -551,38 +751,53 @@ If this is not expected, please contact admin@fedoraproject.org and let them kno
 
         :returns: dict of people, unapproved_paople and search string
         '''
-        groups_to_return_list = groups.split(',')
-        groups_to_return = []
-        # Special Logic, find out all the people who are in more then one group
-        if '@all' in groups_to_return_list:
-            groups_results = Groups.query().filter(Groups.group_type!='cla')
-            for group in groups_results:
-                groups_to_return.append(group.name)
-
-        for group_type in groups_to_return_list:
-            if group_type.startswith('@'):
-                group_list = Groups.query.filter(Groups.group_type.in_(
-                    [group_type.strip('@')]))
-                for group in group_list:
-                    groups_to_return.append(group.name)
+        group_names = []
+        group_types = []
+        all_groups = False
+        for group in groups.split(','):
+            if group == '@all':
+                # Special Logic, find out all the people who are in more
+                # then one group
+                all_groups = True
+            elif group.startswith('@'):
+                group_types.append(group.strip('@'))
             else:
-                groups_to_return.append(group_type)
-        people = People.query.join('roles').filter(
-            PersonRoles.role_status=='approved').join(
-            PersonRoles.group).filter(Groups.name.in_( groups_to_return ))
+                group_names.append(group)
+
+        group_filter = [GroupsTable.c.name.in_(group_names)]
+        if group_types:
+            group_filter.append(GroupsTable.c.group_type.in_(group_types))
+        if all_groups:
+            group_filter.append(GroupsTable.c.group_type != 'cla')
+        members = select([PersonRolesTable.c.person_id],
+                and_(PersonRolesTable.c.role_status == 'approved',
+                    GroupsTable.c.id == PersonRolesTable.c.group_id,
+                    or_(*group_filter)))
+        people = select([PeopleTable.c.username, PeopleTable.c.id,
+            PeopleTable.c.ssh_key, PeopleTable.c.human_name,
+            PeopleTable.c.password, PeopleTable.c.privacy],
+            and_(PeopleTable.c.status == 'active',
+                PeopleTable.c.id.in_(members)))
+
+        # The same rules as filter_private, decided once for all the rows
+        admin = identity.in_any_group(config.get('admingroup', 'accounts'),
+            config.get('systemgroup', 'fas-system'))
+        thirdparty = identity.in_group(config.get('thirdpartygroup',
+            'thirdparty'))
+        requester = identity.current.user_name
 
         # p becomes what we send back via json
         people_dict = []
-        for strip_p in people:
-            strip_p = strip_p.filter_private()
-            if strip_p.status == 'active':
-                people_dict.append({
-                    'username'  : strip_p.username,
-                    'id'        : strip_p.id,
-                    'ssh_key'   : strip_p.ssh_key,
-                    'human_name': strip_p.human_name,
-                    'password'  : strip_p.password
-                    })
+        for username, id, ssh_key, human_name, password, privacy \
+                in people.execute():
+            if not (admin or username == requester):
+                password = '*'
+                if privacy:
+                    human_name = None
+                if not thirdparty:
+                    ssh_key = None
+            people_dict.append(DumpRecord(username, id, ssh_key, human_name,
+                password))
 
         return dict(people=people_dict, unapproved_people=[], search=search)
 
@@ -654,18 +869,6 @@ If this is not expected, please contact admin@fedoraproject.org and let them kno
         if not limit and request_format() != 'json':
             limit = 100
 
-        joined_roles = PeopleTable.outerjoin(PersonRolesTable,
-                onclause=PersonRolesTable.c.person_id==PeopleTable.c.id)\
-                    .outerjoin(GroupsTable,
-                    onclause=PersonRolesTable.c.group_id==GroupsTable.c.id)
-        stmt = select([joined_roles]).where(People.username.ilike(re_search))\
-                .order_by(People.username).limit(limit)
-        stmt.use_labels = True
-        people = stmt.execute()
-
-        people_map = dict()
-        group_map = dict()
-
         # This replicates what filter_private does.  At some point we might
         # want to figure out a way to pull this into a function
         if identity.in_any_group(config.get('admingroup', 'accounts'),
@@ -676,93 +879,25 @@ If this is not expected, please contact admin@fedoraproject.org and let them kno
             user = 'anonymous'
         else:
             user = 'public'
-        # user_perms is a synonym for user with one difference
-        # If user is public then we end up changing user_perms
-        # depending on whether the record is for the user themselves and if
-        # the record has privacy set
-        user_perms = user
-
-        for record in people:
-            if record.people_username not in people_map:
-                # Create a new person
-                person = Bunch()
-                if user == 'public':
-                    # The general public gets different fields depending on
-                    # the record being accessed
-                    if identity.current.user_name == record.people_username:
-                        user_perms = 'self'
-                    elif record.people_privacy:
-                        user_perms = 'privacy'
-                    else:
-                        user_perms = 'public'
-
-                # Clear all the fields so the client side doesn't get KeyError
-                for field in People.allow_fields['complete']:
-                    person[field] = None
-
-                # Fill in the people record
-                for field in People.allow_fields[user_perms]:
-                    person[field] = record['people_%s' % field]
-                if identity.in_group(config.get('thirdpartygroup',
-                    'thirdparty')):
-                    # Thirdparty is a little strange as it has to obey the
-                    # privacy flag just like a normal user but we allow a few
-                    # fields to be sent on in addition (ssh_key for now)
-                    for field in People.allow_fields['thirdparty']:
-                        person[field] = record['people_%s' % field]
-                # Make sure the password field is a default value that won't
-                # cause issue for scripts
-                if 'password' not in People.allow_fields[user_perms]:
-                    person.password = '*'
-
-                person.group_roles = {}
-                person.memberships = []
-                person.roles = []
-                people_map[record.people_username] = person
-            else:
-                # We need to have a reference to the person since we're
-                # going to add a group to it
-                person = people_map[record.people_username]
+        thirdparty = identity.in_group(config.get('thirdpartygroup',
+            'thirdparty'))
 
-            if record.groups_name not in group_map:
-                # Create the group
-                group = Bunch()
-                group.id = record.groups_id
-                group.display_name = record.groups_display_name
-                group.name = record.groups_name
-                group.invite_only = record.groups_invite_only
-                group.url = record.groups_url
-                group.creation = record.groups_creation
-                group.irc_network = record.groups_irc_network
-                group.needs_sponsor = record.groups_needs_sponsor
-                group.prerequisite_id = record.groups_prerequisite_id
-                group.user_can_remove = record.groups_user_can_remove
-                group.mailing_list_url = record.groups_mailing_list_url
-                group.mailing_list = record.groups_mailing_list
-                group.irc_channel = record.groups_irc_channel
-                group.apply_rules = record.groups_apply_rules
-                group.joinmsg = record.groups_joinmsg
-                group.group_type = record.groups_group_type
-                group.owner_id = record.groups_owner_id
-                group_map[record.groups_name] = group
-            else:
-                group = group_map[record.groups_name]
+        if not limit and request_format() == 'json':
+            # The whole directory may have been asked for.  Send people as
+            # they are read instead of building the complete list first.
+            for field in fields:
+                if field not in LIST_FIELDS:
+                    turbogears.flash(_('Invalid field specified: %(error)s') %
+                            {'error': field})
+                    return dict(exc='Invalid', tg_template='json')
+            return stream_json(stream_people_list(re_search, search, fields,
+                user, identity.current.user_name, thirdparty))
 
-            if group.name not in person.group_roles:
-                # Add the group to the person record
-                person.memberships.append(group)
+        people = select([PeopleTable], People.username.ilike(re_search))\
+                .order_by(People.username).limit(limit).execute()
 
-                role = Bunch()
-                role.internal_comments = record.person_roles_internal_comments
-                role.role_status = record.person_roles_role_status
-                role.creation = record.person_roles_creation
-                role.sponsor_id = record.person_roles_sponsor_id
-                role.person_id = record.person_roles_person_id
-                role.approval = record.person_roles_approval
-                role.group_id = record.person_roles_group_id
-                role.role_type = record.person_roles_role_type
-                person.group_roles[group.name] = role
-                person.roles.append(role)
+        people_map = dict(list_people(people, user,
+            identity.current.user_name, thirdparty))
 
         if len(people_map) == 1 and people_map.get(search) and request_format() != 'json':
             turbogears.redirect('/user/view/%s' % search)
@@ -888,6 +1023,7 @@ If this is not expected, please contact admin@fedoraproject.org and let them kno
             (old_email, person.email))
         person.unverified_email = ''
         session.flush()
+        invalidate('user_data')
         turbogears.flash(_('You have successfully changed your email to \'%s\''
             ) % person.email)
         fas.fedmsgshim.send_message(topic="user.update", msg={
@@ -1075,6 +1211,7 @@ forward to working with you!
         'base_url': config.get('base_url_filter.base_url'),
         'webpath': config.get('server.webpath')})
         person.password = newpass['hash']
+        invalidate('user_data')
         fas.fedmsgshim.send_message(topic="user.create", msg={
             'agent': person.username,
             'user': person.username,
@@ -1168,6 +1305,7 @@ forward to working with you!
             person.password_changed = datetime.now(pytz.utc)
             Log(author_id=person.id, description='Password changed')
             session.flush()
+            invalidate('user_data')
         # TODO: Make this catch something specific.
         except:
             Log(author_id=person.id, description='Password change failed!')
@@ -1407,6 +1545,7 @@ To change your password (or to cancel the request), please visit
         changed.append('password')
         Log(author_id=person.id, description='Password changed')
         session.flush()
+        invalidate('user_data')
 
         turbogears.flash(_('You have successfully reset your password.  ' + \
             'You should now be able to login below.'))
@@ -1550,36 +1689,63 @@ automatically revoked, and should stop working within the hour.
     def update_last_seen(self, username, last_seen=None):
         ''' Update the persons last_seen field in the database
 
+        The time is written together with other updates a little later.
+
         :arg username: Username of the person to update
         :arg last_seen: Specify the time they were last seen, else now
                         Format should be string: YYYY,MM,DD,hh,mm,ss
         :returns: Empty dict on success
         '''
-
-        if not last_seen:
-            last_seen = datetime.now(pytz.utc)
-        else:
-            update_time = last_seen.split(',')
-            last_seen = datetime(int(update_time[0]),   # Year
-                                int(update_time[1]),    # Month
-                                int(update_time[2]),    # Day
-                                int(update_time[3]),    # Hour
-                                int(update_time[4]),    # Minute
-                                int(update_time[5]),    # Second
-                                0,                      # ms
-                                pytz.utc)               # tz
         person = People.by_username(username)
-        print "LAST_SEEN: %s" % last_seen
-        person.last_seen = last_seen
-        session.flush()
+        lastseen.seen(person.id, parse_last_seen(last_seen))
         return dict()
 
+    @identity.require(identity.in_group(
+                        config.get('systemgroup', 'fas-system')))
+    @expose(allow_json=True)
+    def update_last_seen_bulk(self, username, last_seen=None):
+        ''' Update the last_seen field of many people at once
+
+        Give username and last_seen once for each person, in the same order.
+
+        :arg username: Usernames of the people to update
+        :arg last_seen: When each of them was last seen, else now
+                        Format should be string: YYYY,MM,DD,hh,mm,ss
+        :returns: dict with the list of usernames that were not found
+        '''
+        if isinstance(username, basestring):
+            username = [username]
+        max_people = int(config.get('last_seen.bulk_max', 1000))
+        if len(username) > max_people:
+            return dict(exc='Invalid',
+                    tg_flash=_('Give at most %d usernames at once') % max_people)
+        if not last_seen:
+            last_seen = [None] * len(username)
+        elif isinstance(last_seen, basestring):
+            last_seen = [last_seen]
+        if len(last_seen) != len(username):
+            return dict(exc='Invalid',
+                    tg_flash=_('Give one last_seen for each username'))
+
+        times = {}
+        for name, when in zip(username, last_seen):
+            when = parse_last_seen(when)
+            if name not in times or times[name] < when:
+                times[name] = when
+        ids = dict(select([PeopleTable.c.username, PeopleTable.c.id],
+            PeopleTable.c.username.in_(times.keys())).execute().fetchall())
+        for name, person_id in ids.items():
+            lastseen.seen(person_id, times[name])
+        lastseen.flush()
+        return dict(unknown=[name for name in times if name not in ids])
+
     @identity.require(identity.not_anonymous())
     @expose()
     def clearkey(self):
         username = identity.current.user_name
         person  = People.by_username(username)
         person.ssh_key = ''
+        invalidate('user_data')
         fas.fedmsgshim.send_message(topic="user.update", msg={
             'agent': person.username,
             'user': person.username,
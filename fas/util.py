@@ -26,6 +26,8 @@ import turbomail
 from turbogears import config
 from turbogears.i18n.tg_gettext import get_locale_dir
 
+from fas import metrics
+
 import logging
 # TODO: Is this right?  
 log = logging.getLogger('fas.util')
@@ -56,6 +58,18 @@ def available_languages():
         our_languages = ['en']
     return our_languages
 
+def smtp_queue_depth():
+    '''Return the number of messages waiting for TurboMail to send them.'''
+    manager = turbomail.control.interface.manager
+    queue = getattr(manager, 'queue', None)
+    if queue is None:
+        return None
+    return queue.qsize()
+
+metrics.describe('fas_smtp_queue_depth', 'gauge',
+        'Messages waiting to be sent by TurboMail')
+metrics.gauge('fas_smtp_queue_depth', smtp_queue_depth)
+
 def send_mail(to_addr, subject, text, from_addr=None):
     if from_addr is None:
         from_addr = config.get('accounts_email')
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2015  Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+'''
+Visit manager that keeps nothing in the database.
+
+Used together with ``identity.stateless``, where who is logged in to a visit
+is kept in a signed cookie (see :class:`fas.safasprovider.SignedVisit`)
+instead of the visit_identity table.  With it the visit table is neither
+written on every new visit nor read on every request.  A visit key is only
+accepted while the client also has a valid token signed for it, otherwise
+the client is given a new visit.
+'''
+
+import re
+
+from turbogears.visit.api import BaseVisitManager, Visit
+
+from fas.safasprovider import SignedVisit
+
+visit_key_re = re.compile('^[0-9a-f]{40}$')
+
+class StatelessVisitManager(BaseVisitManager):
+    '''Hand out visits without recording them.'''
+    def create_model(self):
+        pass
+
+    def new_visit_with_key(self, visit_key):
+        return Visit(visit_key, True)
+
+    def visit_for_key(self, visit_key):
+        if not visit_key or not visit_key_re.match(visit_key):
+            return None
+        if SignedVisit.from_cookie(visit_key) is None:
+            return None
+        return Visit(visit_key, False)
+
+    def update_queued_visits(self, queue):
+        # Expiry is carried by the identity token
+        pass
@@ -230,6 +230,90 @@ create table session (
   expiration_time timestamp
 );
 
+--
+-- Visits logged out of while identity.stateless is on.  Tokens for
+-- visit_key issued before revoked (milliseconds since the epoch) are
+-- refused.  Rows older than identity.token.lifetime may be deleted.
+--
+create table revoked_tokens (
+    visit_key CHAR(40) primary key,
+    revoked BIGINT not null
+);
+
+--
+-- Change sequence used by incremental fasClient syncs.  Every change to the
+-- data that /json/fas_client serves is recorded here so clients can ask for
+-- what changed since their last token, including removed roles and people.
+--
+-- Old rows may be pruned by changetime, but always keep the newest row: the
+-- server compares a client's token against the oldest remaining id to decide
+-- whether it can still answer incrementally.
+--
+create table sync_changes (
+    id serial primary key,
+    tablename text not null,
+    person_id INTEGER,
+    group_id INTEGER,
+    changetime TIMESTAMP WITH TIME ZONE default NOW(),
+    check (tablename in ('people', 'person_roles', 'groups'))
+);
+
+create index sync_changes_changetime_idx on sync_changes(changetime);
+
+create or replace function sync_change() returns trigger as $sync_change$
+    # Only the columns that fasClient consumes matter.  In particular
+    # last_seen is updated on every login and must not flood the table.
+    watched = {
+        'people': ('username', 'password', 'human_name', 'ssh_key', 'email',
+            'privacy', 'alias_enabled', 'status'),
+        'person_roles': ('person_id', 'group_id', 'role_type', 'role_status'),
+        'groups': ('name', 'group_type'),
+    }
+    table = TD['table_name']
+    if TD['event'] == 'UPDATE':
+        for column in watched[table]:
+            if TD['old'][column] != TD['new'][column]:
+                break
+        else:
+            return None
+
+    if TD['event'] == 'DELETE':
+        row = TD['old']
+    else:
+        row = TD['new']
+
+    if table == 'people':
+        ids = (row['id'], None)
+    elif table == 'groups':
+        ids = (None, row['id'])
+    else:
+        ids = (row['person_id'], row['group_id'])
+
+    if 'plan' not in SD:
+        SD['plan'] = plpy.prepare("insert into sync_changes (tablename,"
+            " person_id, group_id) values ($1, $2, $3)",
+            ('text', 'int4', 'int4'))
+    plpy.execute(SD['plan'], (table,) + ids)
+    if TD['event'] == 'UPDATE' and table == 'person_roles' \
+            and TD['old']['group_id'] != TD['new']['group_id']:
+        # Moving a role between groups changes the old group as well
+        plpy.execute(SD['plan'], (table, TD['old']['person_id'],
+            TD['old']['group_id']))
+    return None
+$sync_change$ language plpythonu;
+
+create trigger people_sync_change after update or insert or delete
+  on people
+  for each row execute procedure sync_change();
+
+create trigger person_roles_sync_change after update or insert or delete
+  on person_roles
+  for each row execute procedure sync_change();
+
+create trigger groups_sync_change after update or insert or delete
+  on groups
+  for each row execute procedure sync_change();
+
 --
 -- When the fedorabugs role is updated for a person, add them to bugzilla queue.
 --
@@ -343,7 +427,7 @@ create trigger email_bugzilla_sync before update on people
   for each row execute procedure bugzilla_sync_email();
 
 -- For Fas to connect to the database
-GRANT ALL ON TABLE people, groups, person_roles, bugzilla_queue, configs, configs_id_seq, person_seq, visit, visit_identity, log, log_id_seq, session TO GROUP fedora;
+GRANT ALL ON TABLE people, groups, person_roles, bugzilla_queue, configs, configs_id_seq, person_seq, visit, visit_identity, log, log_id_seq, session, sync_changes, sync_changes_id_seq, revoked_tokens TO GROUP fedora;
 
 -- Create default admin user - Default Password "admin"
 INSERT INTO people (id, username, human_name, password, email) VALUES (100001, 'admin', 'Admin User', '$1$djFfnacd$b6NFqFlac743Lb4sKWXj4/', 'root@localhost');
@@ -38,7 +38,7 @@ from genshi.template.plugin import TextTemplateEnginePlugin
 import fas.sidebar as sidebar
 import logging
 import fas.plugin as plugin
-from fas.auth import can_view_group
+from fas.auth import can_view_group, filter_viewable_groups
 
 from fas.model.fasmodel import Groups, GroupsTable, People
 
@@ -116,10 +116,9 @@ class ShowPlugin(controllers.Controller):
 
         re_search = re.sub(r'\*', r'%', search).lower()
         results = Show.query.filter(Show.name.like(re_search)).order_by('name').all()
-        shows = list()
-        for show in results:
-            if can_view_group(person, show.group):
-                shows.append(show)
+        viewable = frozenset(group.id for group in filter_viewable_groups(
+            person, [show.group for show in results]))
+        shows = [show for show in results if show.group.id in viewable]
         if not len(shows):
             turbogears.flash(_("No Shows found matching '%s'") % search)
         return dict(shows=shows, search=search)
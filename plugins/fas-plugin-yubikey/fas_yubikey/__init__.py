@@ -20,6 +20,8 @@ from fas.model import Log
 from fas.auth import *
 from fas.user import KnownUser
 from fas.util import available_languages
+from fas.otp import verify_otp
+from fas.cache import invalidate
 import fas.fedmsgshim
 
 from random import choice
@@ -108,34 +110,11 @@ def get_configs(configs_list):
 class AuthException(Exception): pass
 
 def otp_verify(uid, otp):
-    import sys, os, re
-    import urllib2
-
-    target = People.by_id(uid)
-    configs = get_configs(Configs.query.filter_by(person_id=target.id, application='yubikey').all())
-
-    if not otp.startswith(configs['prefix']):
-      raise AuthException('Unauthorized/Invalid OTP')
-
-
-    server_prefix = 'http://localhost/yk-val/verify?id='
-    auth_regex = re.compile('^status=(?P<rc>\w{2})')
-
-    server_url = server_prefix + client_id + "&otp=" + otp
-
-    fh = urllib2.urlopen(server_url)
-
-    for line in fh:
-      match = auth_regex.search(line.strip('\n'))
-      if match:
-        if match.group('rc') == 'OK':
-          return
-        else:
-          raise AuthException(line.split('=')[1])
-        break
-
-    turbogears.redirect('/yubikey/')
-    return dict()
+    status = verify_otp(int(uid), otp)
+    if status == 'BAD_PREFIX':
+        raise AuthException('Unauthorized/Invalid OTP')
+    if status != 'OK':
+        raise AuthException(status)
 
 def hex2modhex (string):
     ''' Convert a hex string to a modified hex string '''
@@ -280,6 +259,7 @@ class YubikeyPlugin(controllers.Controller):
         for config in new_configs:
             c = Configs(application='yubikey', attribute=config, value=new_configs[config])
             target.configs.append(c)
+        invalidate('yubikey')
         mail_subject=_('Fedora Yubikey changed for %s' % target)
         mail_text=_('''
 You have changed your Yubikey on your Fedora account %s. If you did not make
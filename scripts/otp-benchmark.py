@@ -0,0 +1,73 @@
+#!/usr/bin/python
+'''Measure how many OTP logins per second the validation step allows.
+
+Starts the stand-in yk-val server from fas.tests.ykval and validates
+distinct OTPs from several threads, once opening a connection per login
+like FAS used to and once through the shared fas.otp client.
+
+Usage: otp-benchmark.py [logins] [threads] [server delay in seconds]
+'''
+__requires__ = 'TurboGears'
+import pkg_resources
+pkg_resources.require('CherryPy >= 2.0, < 3.0alpha')
+
+import sys
+import threading
+import time
+import urllib2
+
+import turbogears
+turbogears.update_config(configfile='test.cfg', modulename='fas.config')
+turbogears.config.update({'memcached_server': '127.0.0.1:11211'})
+
+from fas.otp import OtpClient
+from fas.tests.ykval import YkvalServer
+
+def urlopen_status(url, otp):
+    for line in urllib2.urlopen(url + '1&otp=' + otp):
+        if line.startswith('status='):
+            return line.strip()[len('status='):]
+
+def run(name, validate, logins, threads):
+    counter = iter(xrange(logins))
+    lock = threading.Lock()
+    failures = []
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                number = counter.next()
+            except StopIteration:
+                return
+            finally:
+                lock.release()
+            if validate('cccccccbcjdi%032d' % number) != 'OK':
+                failures.append(number)
+
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - start
+    print '%-10s %8.1f logins/sec (%d failed)' % (name, logins / elapsed,
+            len(failures))
+
+if __name__ == '__main__':
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    delay = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+    server = YkvalServer(delay=delay)
+    server.start()
+    run('urlopen', lambda otp: urlopen_status(server.url, otp), logins,
+            threads)
+    server.seen.clear()
+    server.connections = 0
+    client = OtpClient(server.url, pool_size=threads)
+    run('pooled', client.status, logins, threads)
+    client.close()
+    print 'pooled client opened %d connections' % server.connections
+    server.stop()
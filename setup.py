@@ -221,5 +221,8 @@ setup(
             'turbogears.identity.provider': (
                 'safas4 = fas.safasprovider:SaFasIdentityProvider',
             ),
+            'turbogears.visit.manager': (
+                'fasstateless = fas.visit:StatelessVisitManager',
+            ),
     }
 )